@@ -0,0 +1,250 @@
+"""离线benchmark
+
+启动本地模拟的微信读书和notion服务器，用合成的书架依次跑四次同步：
+全量同步、部分书有新划线的增量同步、没有任何变化的同步、部分书只有阅读进度变化的同步。
+记录每次的耗时、notion和微信读书的请求数、传输的字节数和内存峰值。
+最后模拟写入notion时中断，检查续传和不续传的下一次同步后每本书都只有一个完整的page。
+
+    python benchmark/run.py --books 200 --max-highlights 2000 --output result.json
+"""
+import argparse
+import json
+import os
+import random
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from servers import FakeNotion, FakeWeRead, Library, serve
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(ROOT, "scripts", "weread.py")
+
+
+def run_sync(workdir, weread, notion, weread_url, notion_url, sync_args, name):
+    """在workdir中运行一次同步，返回这次同步的统计"""
+    weread.stats.reset()
+    notion.stats.reset()
+    env = dict(
+        os.environ,
+        WEREAD_URL=f"{weread_url}/",
+        WEREAD_API_URL=weread_url,
+        NOTION_BASE_URL=notion_url,
+    )
+    command = [
+        sys.executable,
+        SCRIPT,
+        "wr_skey=benchmark",
+        "secret_benchmark",
+        "benchmark",
+        "refs/heads/main",
+        "benchmark/weread2notion",
+        "--styles",
+        "0",
+        "1",
+        "2",
+        "--colors",
+        "0",
+        "1",
+        "2",
+        "3",
+        "4",
+        "5",
+        *sync_args,
+    ]
+    with open(os.path.join(workdir, f"{name}.log"), "w") as log:
+        start = time.perf_counter()
+        process = subprocess.Popen(
+            command, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT
+        )
+        notion.process = process
+        # 用wait4拿到子进程自己的资源使用情况
+        _, status, usage = os.wait4(process.pid, 0)
+        elapsed = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return {
+        "exit_code": process.returncode,
+        "wall_time": round(elapsed, 3),
+        # linux下ru_maxrss的单位是KB
+        "peak_rss_mb": round(usage.ru_maxrss / 1024, 1),
+        "notion": notion.stats.to_dict(),
+        "weread": weread.stats.to_dict(),
+        "notion_blocks": notion.count_blocks(),
+    }
+
+
+APPEND = "PATCH /blocks/{id}/children"
+CREATE = "POST /pages"
+# (场景, 模拟的中断, 中断的接口, 前面成功的请求数)
+CRASHES = [
+    ("reject append", "reject", APPEND, 3),
+    ("lost append", "lost", APPEND, 3),
+    ("kill append", "kill", APPEND, 3),
+    ("lost create", "lost", CREATE, 2),
+    ("kill create", "kill", CREATE, 2),
+]
+
+
+def run_crashes(weread, weread_url, sync_args, workdir):
+    """每种中断分别用续传和不续传再同步一次，和没有中断的同步对比notion中的内容
+
+    返回每个场景的结果，每本书都只有一个page并且内容完整时ok为True
+    """
+    notion = FakeNotion()
+    server, url = serve(notion)
+    directory = os.path.join(workdir, "clean")
+    os.makedirs(directory)
+    try:
+        run_sync(directory, weread, notion, weread_url, url, sync_args, "clean")
+    finally:
+        server.shutdown()
+    expected = notion.get_contents()
+    results = {}
+    for scenario, mode, endpoint, after in CRASHES:
+        for resume in (False, True):
+            name = scenario + (" --resume" if resume else "")
+            notion = FakeNotion()
+            server, url = serve(notion)
+            directory = os.path.join(workdir, name.replace(" ", "_"))
+            os.makedirs(directory)
+            try:
+                notion.crash(endpoint, after, mode)
+                crashed = run_sync(directory, weread, notion, weread_url, url, sync_args, "crash")
+                args = sync_args + ["--resume"] if resume else sync_args
+                result = run_sync(directory, weread, notion, weread_url, url, args, "rerun")
+            finally:
+                server.shutdown()
+            contents = notion.get_contents()
+            duplicates = sorted(x for x, pages in contents.items() if len(pages) > 1)
+            incomplete = sorted(
+                x for x in expected if contents.get(x, [None])[0] != expected[x][0]
+            )
+            results[name] = {
+                "ok": crashed["exit_code"] != 0
+                and result["exit_code"] == 0
+                and len(duplicates) == 0
+                and len(incomplete) == 0
+                and contents.keys() == expected.keys(),
+                "exit_codes": [crashed["exit_code"], result["exit_code"]],
+                "notion_calls": result["notion"]["calls"],
+                "duplicates": duplicates,
+                "incomplete": incomplete,
+            }
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """请求数比基准多出tolerance以上时返回错误信息"""
+    errors = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for service in ("notion", "weread"):
+            expected = baseline[name][service]["calls"]
+            actual = result[service]["calls"]
+            if actual > expected * (1 + tolerance):
+                errors.append(f"{name} {service}: {actual} calls, baseline {expected}")
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description="离线同步benchmark")
+    parser.add_argument("--books", type=int, default=50, help="书的数量")
+    parser.add_argument("--min-highlights", type=int, default=0, help="每本书最少的划线数")
+    parser.add_argument("--max-highlights", type=int, default=200, help="每本书最多的划线数")
+    parser.add_argument("--changed", type=float, default=0.1, help="增量同步时有新划线的书的比例")
+    parser.add_argument("--seed", type=int, default=0, help="随机种子")
+    parser.add_argument("--latency", type=float, default=0, help="模拟的每个请求的延迟，单位毫秒")
+    parser.add_argument(
+        "--sync-args",
+        default="--incremental --notion-rate 100 --notion-burst 100",
+        help="传给weread.py的其它参数",
+    )
+    parser.add_argument("--output", help="把结果写入json文件")
+    parser.add_argument("--baseline", help="和之前的结果对比，请求数变多时返回非0")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="允许请求数比基准多的比例")
+    parser.add_argument("--keep", action="store_true", help="保留工作目录和日志")
+    parser.add_argument("--skip-crash", action="store_true", help="不运行中断后再同步的检查")
+    options = parser.parse_args()
+
+    library = Library(
+        options.books, options.min_highlights, options.max_highlights, options.seed
+    )
+    weread = FakeWeRead(library, options.latency / 1000)
+    notion = FakeNotion(options.latency / 1000)
+    weread_server, weread_url = serve(weread)
+    notion_server, notion_url = serve(notion)
+    weread.url = weread_url
+    sync_args = shlex.split(options.sync_args)
+    workdir = tempfile.mkdtemp(prefix="weread-benchmark-")
+    results = {}
+    crashes = {}
+    try:
+        results["full"] = run_sync(
+            workdir, weread, notion, weread_url, notion_url, sync_args, "full"
+        )
+        rnd = random.Random(options.seed)
+        bookIds = list(library.books)
+        for bookId in rnd.sample(bookIds, int(len(bookIds) * options.changed)):
+            library.touch(bookId, rnd.randint(1, 5))
+        results["incremental"] = run_sync(
+            workdir, weread, notion, weread_url, notion_url, sync_args, "incremental"
+        )
+        results["noop"] = run_sync(
+            workdir, weread, notion, weread_url, notion_url, sync_args, "noop"
+        )
+        # 只有阅读进度变化，划线和笔记都没有变化
+        for bookId in rnd.sample(bookIds, int(len(bookIds) * options.changed)):
+            library.touch(bookId, 0)
+        results["progress"] = run_sync(
+            workdir, weread, notion, weread_url, notion_url, sync_args, "progress"
+        )
+        if not options.skip_crash:
+            # 书少一些，每本书的划线多一些，中断时正在写入的书有多批block
+            weread.library = Library(8, 150, 600, options.seed)
+            crashes = run_crashes(weread, weread_url, sync_args, workdir)
+    finally:
+        weread_server.shutdown()
+        notion_server.shutdown()
+        if options.keep:
+            print(f"工作目录：{workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"{'':12}{'耗时(s)':>10}{'notion':>10}{'weread':>10}{'上传(KB)':>12}{'内存(MB)':>10}")
+    for name, result in results.items():
+        print(
+            f"{name:12}{result['wall_time']:>10}{result['notion']['calls']:>10}"
+            f"{result['weread']['calls']:>10}{result['notion']['bytes_in'] // 1024:>12}"
+            f"{result['peak_rss_mb']:>10}"
+        )
+    if len(crashes) > 0:
+        print()
+        print(f"{'中断后再同步':28}{'结果':>6}{'notion':>10}")
+        for name, result in crashes.items():
+            print(f"{name:28}{'ok' if result['ok'] else 'FAIL':>8}{result['notion_calls']:>10}")
+    report = {"options": vars(options), "results": results, "crashes": crashes}
+    if options.output:
+        with open(options.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    failed = [name for name, result in results.items() if result["exit_code"] != 0]
+    if failed:
+        print(f"同步失败：{', '.join(failed)}")
+        sys.exit(1)
+    failed = [name for name, result in crashes.items() if not result["ok"]]
+    if failed:
+        print(f"中断后再同步的结果不对：{', '.join(failed)}")
+        sys.exit(1)
+    if options.baseline:
+        with open(options.baseline, encoding="utf-8") as f:
+            errors = compare(results, json.load(f)["results"], options.tolerance)
+        if errors:
+            print("\n".join(errors))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,471 @@
+"""本地模拟的微信读书和notion服务器，只实现了同步用到的接口"""
+import json
+import os
+import random
+import re
+import signal
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class Stats:
+    """按接口统计请求次数和传输的字节数"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.calls = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def record(self, endpoint, bytes_in, bytes_out):
+        with self.lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+
+    def to_dict(self):
+        return {
+            "calls": sum(self.calls.values()),
+            "endpoints": dict(sorted(self.calls.items())),
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+        }
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def handle(self):
+        try:
+            super().handle()
+        except ConnectionResetError:
+            # 模拟中断时同步的进程被杀掉了
+            pass
+
+    def handle_request(self, method):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length > 0 else b""
+        if len(body) < length:
+            # 发送请求时进程被杀掉了，请求不完整
+            return
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        app = self.server.app
+        if app.latency > 0:
+            time.sleep(app.latency)
+        endpoint, status, data, headers = app.handle(method, url.path, query, body)
+        if not isinstance(data, bytes):
+            data = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        app.stats.record(endpoint, len(body), len(data))
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def do_PATCH(self):
+        self.handle_request("PATCH")
+
+    def do_DELETE(self):
+        self.handle_request("DELETE")
+
+
+def serve(app):
+    """在后台线程启动服务器，返回服务器和它的地址"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    server.app = app
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+JSON = {"Content-Type": "application/json"}
+
+
+class Library:
+    """合成的书架，划线在请求时按种子生成，不会一次性占用大量内存"""
+
+    def __init__(self, books=10, min_highlights=0, max_highlights=200, seed=0):
+        rnd = random.Random(seed)
+        self.seed = seed
+        self.books = {}
+        for index in range(books):
+            bookId = str(100000 + index)
+            self.books[bookId] = {
+                "highlights": rnd.randint(min_highlights, max_highlights),
+                "reviews": rnd.randint(0, 5),
+                "chapters": rnd.randint(5, 40),
+                "sort": 1600000000 + index * 3600,
+                "version": rnd.randint(1, 1 << 30),
+                # 增量同步时新增的划线数
+                "added": 0,
+            }
+
+    def notebook(self, bookId, cover_base):
+        book = self.books[bookId]
+        return {
+            "bookId": bookId,
+            "book": {
+                "bookId": bookId,
+                "title": f"书{bookId}",
+                "author": "作者",
+                "cover": f"{cover_base}/cover/{bookId}/s_{bookId}",
+                "version": book["version"],
+                "categories": [{"categoryId": 1, "title": "文学-散文杂著"}],
+            },
+            "reviewCount": book["reviews"],
+            "noteCount": book["highlights"] + book["added"],
+            "bookmarkCount": 0,
+            "sort": book["sort"],
+        }
+
+    def chapters(self, bookId):
+        return [
+            {"chapterUid": uid, "level": 1 + uid % 2, "title": f"第{uid}章"}
+            for uid in range(1, self.books[bookId]["chapters"] + 1)
+        ]
+
+    def bookmarks(self, bookId):
+        book = self.books[bookId]
+        rnd = random.Random(f"{self.seed}-{bookId}")
+        result = []
+        for index in range(book["highlights"] + book["added"]):
+            start = rnd.randint(0, 100000)
+            text = "划线内容" * rnd.choice([2, 5, 10, 30, 600])
+            result.append(
+                {
+                    "bookmarkId": f"{bookId}_{index}",
+                    "bookId": bookId,
+                    "chapterUid": rnd.randint(1, book["chapters"]),
+                    "range": f"{start}-{start + len(text)}",
+                    "markText": text,
+                    "style": rnd.randint(0, 2),
+                    "colorStyle": rnd.randint(1, 5),
+                    "createTime": 1600000000 + index,
+                }
+            )
+        return result
+
+    def reviews(self, bookId):
+        book = self.books[bookId]
+        rnd = random.Random(f"{self.seed}-{bookId}-review")
+        result = []
+        for index in range(book["reviews"]):
+            start = rnd.randint(0, 100000)
+            result.append(
+                {
+                    "review": {
+                        "reviewId": f"{bookId}_r{index}",
+                        "bookId": bookId,
+                        "type": 1,
+                        "chapterUid": rnd.randint(1, book["chapters"]),
+                        "range": f"{start}-{start + 20}",
+                        "content": "想法" * rnd.randint(5, 100),
+                        "abstract": "原文" * rnd.randint(5, 50),
+                    }
+                }
+            )
+        if book["reviews"] > 0:
+            result.append(
+                {
+                    "review": {
+                        "reviewId": f"{bookId}_s",
+                        "bookId": bookId,
+                        "type": 4,
+                        "content": "点评" * 50,
+                    }
+                }
+            )
+        return result
+
+    def touch(self, bookId, added=1):
+        """模拟在这本书上新增了划线，added为0时只是阅读进度变了"""
+        book = self.books[bookId]
+        book["added"] += added
+        book["sort"] += 86400
+
+
+class FakeWeRead:
+    """模拟i.weread.qq.com的接口，封面也由它提供"""
+
+    def __init__(self, library, latency=0):
+        self.library = library
+        self.latency = latency
+        self.stats = Stats()
+        self.url = ""
+
+    def handle(self, method, path, query, body):
+        library = self.library
+        if path.startswith("/cover/"):
+            data = (path * 200).encode("utf-8")
+            return "cover", 200, data, {"Content-Type": "image/jpeg", "ETag": '"1"'}
+        if path == "/user/notebooks":
+            books = [library.notebook(x, self.url) for x in library.books]
+            return path, 200, {"books": books, "synckey": 1}, JSON
+        if path == "/book/chapterInfos":
+            body = json.loads(body)
+            synckeys = body.get("synckeys") or [0] * len(body["bookIds"])
+            data = []
+            for bookId, synckey in zip(body["bookIds"], synckeys):
+                version = library.books[bookId]["version"]
+                data.append(
+                    {
+                        "bookId": bookId,
+                        "synckey": version,
+                        "updated": [] if synckey == version else library.chapters(bookId),
+                    }
+                )
+            return path, 200, {"data": data}, JSON
+        bookId = query.get("bookId")
+        if bookId != None and bookId not in library.books:
+            return path, 404, {"errcode": -2003, "errmsg": "book not found"}, JSON
+        if path == "/book/bookmarklist":
+            data = {"updated": library.bookmarks(bookId), "synckey": 1}
+            return path, 200, data, JSON
+        if path == "/review/list":
+            data = {"reviews": library.reviews(bookId), "synckey": 1, "removed": []}
+            return path, 200, data, JSON
+        if path == "/book/readinfo":
+            data = {
+                "markedStatus": 4,
+                "readingTime": 7200,
+                "readingProgress": 100,
+                "finishedDate": 1650000000,
+                "readDetail": {
+                    "data": [
+                        {"readDate": 1650000000 - 86400 * i, "readTime": 600 * (i % 4)}
+                        for i in range(int(bookId) % 30)
+                    ]
+                },
+            }
+            return path, 200, data, JSON
+        if path == "/readdata/summary":
+            # 整个账号每天的阅读时长，比有笔记的书多一些
+            readTimes = {str(1650000000 - 86400 * i): 900 for i in range(60)}
+            return path, 200, {"readTimes": readTimes, "synckey": 1650000000}, JSON
+        if path == "/book/info":
+            data = {"bookId": bookId, "isbn": f"978{bookId}", "newRating": 850}
+            return path, 200, data, JSON
+        return "other", 200, {}, JSON
+
+
+class FakeNotion:
+    """模拟notion api，在内存中保存page和block，用于对比同步后的结果"""
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.stats = Stats()
+        self.pages = {}
+        self.blocks = {}
+        self.lock = threading.Lock()
+        # 模拟中断，见crash()
+        self.crash_at = None
+        # 正在同步的进程，kill时使用
+        self.process = None
+
+    def crash(self, endpoint, after, mode):
+        """第after+1次请求endpoint时模拟同步中断
+
+        reject：notion拒绝了请求，没有写入；lost：写入后返回502；kill：写入后杀掉同步的进程
+        """
+        self.crash_at = [endpoint, after, mode]
+
+    def should_crash(self, endpoint):
+        if self.crash_at == None or self.crash_at[0] != endpoint:
+            return None
+        if self.crash_at[1] > 0:
+            self.crash_at[1] -= 1
+            return None
+        mode = self.crash_at[2]
+        self.crash_at = None
+        return mode
+
+    def error(self, endpoint, status, code, message):
+        data = {"object": "error", "status": status, "code": code, "message": message}
+        return endpoint, status, data, JSON
+
+    def create_blocks(self, parent, children):
+        ids = []
+        for child in children:
+            type = child["type"]
+            value = dict(child[type])
+            nested = value.pop("children", [])
+            id = str(uuid.uuid4())
+            self.blocks[id] = {
+                "object": "block",
+                "id": id,
+                "type": type,
+                type: value,
+                "has_children": len(nested) > 0,
+                "archived": False,
+                "children": self.create_blocks(id, nested),
+            }
+            ids.append(id)
+        return ids
+
+    def public_block(self, id):
+        return {k: v for k, v in self.blocks[id].items() if k != "children"}
+
+    def public_page(self, id):
+        return {k: v for k, v in self.pages[id].items() if k != "children"}
+
+    def handle(self, method, path, query, body):
+        body = json.loads(body) if body else {}
+        path = path[len("/v1") :]
+        endpoint = method + " " + re.sub(r"/[0-9a-f-]{32,36}", "/{id}", path)
+        with self.lock:
+            mode = self.should_crash(endpoint)
+            if mode == "reject":
+                return self.error(endpoint, 400, "validation_error", "rejected")
+            result = self.route(endpoint, method, path, query, body)
+            if mode == "lost":
+                return self.error(endpoint, 502, "internal_server_error", "bad gateway")
+            if mode == "kill":
+                os.kill(self.process.pid, signal.SIGKILL)
+            return result
+
+    def route(self, endpoint, method, path, query, body):
+        match = re.match(r"/databases/([^/]+)/query$", path)
+        if match:
+            pages = [
+                x
+                for x in self.pages
+                if not self.pages[x]["archived"]
+                and self.pages[x]["parent"].get("database_id") == match.group(1)
+                and self.match_filter(self.pages[x], body.get("filter"))
+            ]
+            start = int(body.get("start_cursor") or 0)
+            size = body.get("page_size", 100)
+            results = [self.public_page(x) for x in pages[start : start + size]]
+            more = start + size < len(pages)
+            data = {
+                "object": "list",
+                "results": results,
+                "has_more": more,
+                "next_cursor": str(start + size) if more else None,
+            }
+            return endpoint, 200, data, JSON
+        if path == "/pages" and method == "POST":
+            id = str(uuid.uuid4())
+            children = body.get("children", [])
+            if len(children) > 100:
+                return self.error(endpoint, 400, "validation_error", "too many children")
+            self.pages[id] = {
+                "object": "page",
+                "id": id,
+                "parent": body.get("parent") or {},
+                "properties": body.get("properties"),
+                "archived": False,
+                "children": self.create_blocks(id, children),
+            }
+            return endpoint, 200, self.public_page(id), JSON
+        match = re.match(r"/pages/([^/]+)$", path)
+        if match and method == "PATCH":
+            page = self.pages.get(match.group(1))
+            if page == None:
+                return self.error(endpoint, 404, "object_not_found", "page not found")
+            if page["archived"]:
+                return self.error(endpoint, 400, "validation_error", "archived")
+            page["properties"].update(body.get("properties", {}))
+            return endpoint, 200, self.public_page(match.group(1)), JSON
+        match = re.match(r"/blocks/([^/]+)/children$", path)
+        if match:
+            parent = self.pages.get(match.group(1)) or self.blocks.get(match.group(1))
+            if parent == None:
+                return self.error(endpoint, 404, "object_not_found", "block not found")
+            if method == "PATCH":
+                if len(body["children"]) > 100:
+                    return self.error(endpoint, 400, "validation_error", "too many children")
+                ids = self.create_blocks(match.group(1), body["children"])
+                children = parent["children"]
+                index = len(children)
+                if body.get("after") in children:
+                    index = children.index(body["after"]) + 1
+                children[index:index] = ids
+                data = {"object": "list", "results": [self.public_block(x) for x in ids]}
+                return endpoint, 200, data, JSON
+            children = [x for x in parent["children"] if not self.blocks[x]["archived"]]
+            start = int(query.get("start_cursor") or 0)
+            size = int(query.get("page_size") or 100)
+            more = start + size < len(children)
+            data = {
+                "object": "list",
+                "results": [self.public_block(x) for x in children[start : start + size]],
+                "has_more": more,
+                "next_cursor": str(start + size) if more else None,
+            }
+            return endpoint, 200, data, JSON
+        match = re.match(r"/blocks/([^/]+)$", path)
+        if match:
+            id = match.group(1)
+            target = self.pages.get(id) or self.blocks.get(id)
+            if target == None:
+                return self.error(endpoint, 404, "object_not_found", "block not found")
+            if method == "DELETE":
+                target["archived"] = True
+            elif method == "PATCH":
+                target.update(body)
+            data = self.public_page(id) if id in self.pages else self.public_block(id)
+            return endpoint, 200, data, JSON
+        return self.error(endpoint, 404, "object_not_found", path)
+
+    def match_filter(self, page, filter):
+        """只支持按rich_text属性相等查询"""
+        if filter == None:
+            return True
+        value = filter["rich_text"]["equals"]
+        return get_text(page["properties"].get(filter["property"])) == value
+
+    def get_contents(self):
+        """bookId到这本书所有未删除page的内容的字典，用于对比两次同步的结果"""
+
+        def walk(ids):
+            result = []
+            for x in ids:
+                block = self.blocks[x]
+                if not block["archived"]:
+                    value = json.dumps(block[block["type"]], sort_keys=True)
+                    result.append((block["type"], value, walk(block["children"])))
+            return result
+
+        contents = {}
+        with self.lock:
+            pages = list(self.pages.values())
+        for page in pages:
+            if not page["archived"]:
+                bookId = get_text(page["properties"].get("BookId"))
+                contents.setdefault(bookId, []).append(walk(page["children"]))
+        return contents
+
+    def count_blocks(self):
+        """所有未删除page下的block数量"""
+
+        def count(ids):
+            ids = [x for x in ids if not self.blocks[x]["archived"]]
+            return len(ids) + sum(count(self.blocks[x]["children"]) for x in ids)
+
+        return sum(
+            count(page["children"]) for page in self.pages.values() if not page["archived"]
+        )
+
+
+def get_text(value):
+    return "".join(
+        x.get("text", {}).get("content", "") for x in (value or {}).get("rich_text", [])
+    )
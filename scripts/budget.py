@@ -0,0 +1,81 @@
+import threading
+import time
+
+# 还没有同步过任何书时的估计：每本书1秒，每条划线或block 0.01秒
+DEFAULT_BOOK_SECONDS = 1
+DEFAULT_UNIT_SECONDS = 0.01
+
+
+def get_cost(book, block_counts):
+    """估计同步一本书的工作量，取笔记本列表中的笔记数和上次写入的block数中较大的"""
+    notes = (book.noteCount or 0) + (book.reviewCount or 0)
+    return max(notes, block_counts.get(book.bookId, 0)) + 1
+
+
+def prioritize(books, deferred, block_counts):
+    """决定同步的顺序：上次没来得及同步的书最先，然后按最后阅读的日期从近到远，同一天读的书工作量小的在前
+
+    sort是最后阅读的时间戳，几乎不会重复，按天比较工作量才能影响顺序
+    """
+    deferred = set(deferred)
+    return sorted(
+        books,
+        key=lambda x: (
+            x[1].bookId not in deferred,
+            -(x[1].sort // 86400),
+            get_cost(x[1], block_counts),
+            -x[1].sort,
+        ),
+    )
+
+
+class TimeBudget:
+    """在截止时间之前尽量多同步几本书
+
+    按这次运行中已经写完的书的速度估计剩下的书要多久，交给writer还没写完的书也算在内，
+    来不及的书留到下次，剩下的时间不到margin秒时不再开始新的书。seconds为None时没有限制
+    """
+
+    def __init__(self, seconds=None, margin=30):
+        self.seconds = seconds
+        self.margin = margin
+        self.started = time.monotonic()
+        # 已经写完的和正在写入的工作量，writer的线程写完一本书时更新
+        self.units = 0
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def remaining(self):
+        if self.seconds == None:
+            return float("inf")
+        return self.seconds - self.margin - self.elapsed()
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def estimate(self, units):
+        with self.lock:
+            done = self.units
+        if done == 0:
+            return DEFAULT_BOOK_SECONDS + units * DEFAULT_UNIT_SECONDS
+        return units * self.elapsed() / done
+
+    def fits(self, units):
+        """加上正在写入的书，来得及同步这么多工作量时返回True"""
+        with self.lock:
+            pending = self.pending
+        return self.estimate(pending + units) <= self.remaining()
+
+    def start(self, units):
+        """开始同步一本书"""
+        with self.lock:
+            self.pending += units
+
+    def finish(self, units):
+        """一本书写完了，包括交给writer的写入，失败时也要调用"""
+        with self.lock:
+            self.pending -= units
+            self.units += units
@@ -0,0 +1,64 @@
+import json
+import os
+import threading
+
+
+class ResponseCache:
+    """微信读书接口返回数据的本地缓存
+
+    每本书每种数据一个文件，按bookId和book.version区分，书的version变了缓存就失效。
+    同时保存接口返回的synckey，下次请求时带上，没有变化的数据直接使用缓存。
+    总大小超过max_bytes时删除最久没有使用的文件。
+    """
+
+    def __init__(self, path="cache", max_bytes=64 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+    def get_path(self, kind, bookId):
+        return os.path.join(self.path, kind, f"{bookId}.json")
+
+    def get(self, kind, bookId, version):
+        """返回缓存的数据，格式为{"synckey": ..., "data": ...}，没有缓存或者version不一致返回None"""
+        path = self.get_path(kind, bookId)
+        try:
+            with open(path, encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry.get("version") != version:
+            return None
+        # 更新修改时间，淘汰时按最近使用的时间排序
+        os.utime(path)
+        return entry
+
+    def set(self, kind, bookId, version, data, synckey=0):
+        path = self.get_path(kind, bookId)
+        dirname = os.path.dirname(path)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname, exist_ok=True)
+        entry = {"version": version, "synckey": synckey, "data": data}
+        # 先写临时文件再替换，避免中途退出留下不完整的缓存
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(tmp, path)
+
+    def evict(self):
+        """缓存超过大小限制时，从最久没有使用的文件开始删除"""
+        with self.lock:
+            files = []
+            total = 0
+            for root, _, names in os.walk(self.path):
+                for name in names:
+                    path = os.path.join(root, name)
+                    stat = os.stat(path)
+                    files.append((stat.st_mtime, stat.st_size, path))
+                    total += stat.st_size
+            files.sort()
+            for _, size, path in files:
+                if total <= self.max_bytes:
+                    break
+                os.remove(path)
+                total -= size
@@ -0,0 +1,251 @@
+import base64
+import gzip
+import hashlib
+import io
+import json
+import os
+import tarfile
+import tempfile
+import threading
+from collections import defaultdict, deque
+from datetime import timedelta
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+CASSETTE_VERSION = 1
+# 保存的是解压后的内容，回放时不能再按这些头解压
+SKIP_HEADERS = {"content-encoding", "content-length", "transfer-encoding"}
+# 访问首页时返回的Set-Cookie是刷新后的wr_skey，录制的文件要分享给别人，回放时也用不到
+SECRET_HEADERS = {"set-cookie", "set-cookie2", "authorization", "proxy-authorization"}
+
+
+class CassetteMiss(Exception):
+    """回放时请求在录制的文件中找不到"""
+
+
+def get_key(method, url, body):
+    """同一个请求的key相同，query参数和json的key按顺序排列"""
+    parts = urlsplit(str(url))
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    url = urlunsplit((parts.scheme, parts.netloc, parts.path, query, ""))
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    if body:
+        try:
+            body = json.dumps(json.loads(body), sort_keys=True).encode("utf-8")
+        except ValueError:
+            pass
+        digest = hashlib.sha1(body).hexdigest()
+    else:
+        digest = ""
+    return f"{method.upper()} {url} {digest}"
+
+
+def check_members(tar, root):
+    """录制的文件可能来自别人，只允许解压到root中的普通文件和目录"""
+    root = os.path.realpath(root)
+    for member in tar.getmembers():
+        path = os.path.realpath(os.path.join(root, member.name))
+        if (
+            os.path.isabs(member.name)
+            or not path.startswith(root + os.sep)
+            or not (member.isfile() or member.isdir())
+        ):
+            raise ValueError(f"录制的文件中有不安全的路径：{member.name}")
+
+
+class Cassette:
+    """把微信读书和notion的所有请求和响应录制到一个gzip压缩的文件中，之后离线回放
+
+    文件的第一行是录制开始时的本地状态、索引、缓存和封面，回放时解压到临时目录，
+    所以回放的每个请求都和录制时一样。之后每行是一个请求的key和响应，
+    回放时同一个key的响应按录制的顺序依次返回
+    """
+
+    def __init__(self, path, replay=False):
+        self.path = path
+        self.replay = replay
+        self.lock = threading.Lock()
+        self.entries = []
+        self.responses = defaultdict(deque)
+        self.snapshot = None
+        if replay:
+            self.load()
+
+    def load(self):
+        with gzip.open(self.path, "rt", encoding="utf-8") as f:
+            header = json.loads(f.readline())
+            if header.get("version") != CASSETTE_VERSION:
+                raise ValueError(f"{self.path} 的版本不支持")
+            self.snapshot = header.get("snapshot")
+            for line in f:
+                entry = json.loads(line)
+                self.responses[entry["key"]].append(entry)
+
+    def save(self):
+        if self.replay:
+            return
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        with gzip.open(self.path, "wt", encoding="utf-8") as f:
+            header = {"version": CASSETTE_VERSION, "snapshot": self.snapshot}
+            f.write(json.dumps(header) + "\n")
+            with self.lock:
+                for entry in self.entries:
+                    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        print(f"录制了{len(self.entries)}个请求，已写入 {self.path}")
+
+    def take_snapshot(self, paths):
+        """录制开始前保存本地文件，paths是名字到文件或目录的字典"""
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode="w:gz") as tar:
+            for name, path in paths.items():
+                if path and os.path.exists(path):
+                    tar.add(path, arcname=name)
+        self.snapshot = base64.b64encode(buffer.getvalue()).decode("ascii")
+
+    def restore_snapshot(self, names):
+        """把录制时的本地文件解压到临时目录，返回名字到新路径的字典"""
+        root = tempfile.mkdtemp(prefix="weread-replay-")
+        if self.snapshot:
+            data = base64.b64decode(self.snapshot)
+            with tarfile.open(fileobj=io.BytesIO(data), mode="r:gz") as tar:
+                check_members(tar, root)
+                if hasattr(tarfile, "data_filter"):
+                    tar.extractall(root, filter="data")
+                else:
+                    tar.extractall(root)
+        return {name: os.path.join(root, name) for name in names}
+
+    def record(self, method, url, body, status, headers, content):
+        entry = {
+            "key": get_key(method, url, body),
+            "status": status,
+            "headers": [
+                [k, v]
+                for k, v in headers
+                if k.lower() not in SKIP_HEADERS and k.lower() not in SECRET_HEADERS
+            ],
+            "content": base64.b64encode(content).decode("ascii"),
+        }
+        with self.lock:
+            self.entries.append(entry)
+
+    def play(self, method, url, body):
+        """返回录制的状态码、响应头和内容"""
+        key = get_key(method, url, body)
+        with self.lock:
+            if len(self.responses[key]) == 0:
+                raise CassetteMiss(f"录制的文件中没有这个请求：{key}")
+            entry = self.responses[key].popleft()
+        return entry["status"], entry["headers"], base64.b64decode(entry["content"])
+
+    def mount(self, session, **kwargs):
+        """让requests的session通过cassette发出请求，kwargs是HTTPAdapter的参数"""
+        adapter = CassetteAdapter(self, **kwargs)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+
+    def transport(self):
+        return CassetteTransport(self)
+
+    def async_transport(self):
+        return AsyncCassetteTransport(self)
+
+
+class CassetteAdapter(HTTPAdapter):
+    """requests的adapter，录制时正常请求并保存响应，回放时直接返回录制的响应"""
+
+    def __init__(self, cassette, **kwargs):
+        super().__init__(**kwargs)
+        self.cassette = cassette
+
+    def send(self, request, **kwargs):
+        if not self.cassette.replay:
+            response = super().send(request, **kwargs)
+            self.cassette.record(
+                request.method,
+                request.url,
+                request.body,
+                response.status_code,
+                response.headers.items(),
+                response.content,
+            )
+            return response
+        status, headers, content = self.cassette.play(
+            request.method, request.url, request.body
+        )
+        response = requests.Response()
+        response.status_code = status
+        response.headers = CaseInsensitiveDict(headers)
+        response.encoding = get_encoding_from_headers(response.headers)
+        response._content = content
+        response._content_consumed = True
+        response.url = request.url
+        response.request = request
+        response.elapsed = timedelta(0)
+        return response
+
+
+class CassetteTransport(httpx.BaseTransport):
+    """httpx的transport，notion的同步client使用"""
+
+    def __init__(self, cassette):
+        self.cassette = cassette
+        self.transport = None if cassette.replay else httpx.HTTPTransport()
+
+    def handle_request(self, request):
+        body = request.read()
+        if self.cassette.replay:
+            status, headers, content = self.cassette.play(request.method, request.url, body)
+            return httpx.Response(status, headers=headers, content=content)
+        response = self.transport.handle_request(request)
+        response.read()
+        self.cassette.record(
+            request.method,
+            request.url,
+            body,
+            response.status_code,
+            response.headers.multi_items(),
+            response.content,
+        )
+        return response
+
+    def close(self):
+        if self.transport != None:
+            self.transport.close()
+
+
+class AsyncCassetteTransport(httpx.AsyncBaseTransport):
+    """和CassetteTransport一样，notion的AsyncClient使用"""
+
+    def __init__(self, cassette):
+        self.cassette = cassette
+        self.transport = None if cassette.replay else httpx.AsyncHTTPTransport()
+
+    async def handle_async_request(self, request):
+        body = await request.aread()
+        if self.cassette.replay:
+            status, headers, content = self.cassette.play(request.method, request.url, body)
+            return httpx.Response(status, headers=headers, content=content)
+        response = await self.transport.handle_async_request(request)
+        await response.aread()
+        self.cassette.record(
+            request.method,
+            request.url,
+            body,
+            response.status_code,
+            response.headers.multi_items(),
+            response.content,
+        )
+        return response
+
+    async def aclose(self):
+        if self.transport != None:
+            await self.transport.aclose()
@@ -0,0 +1,132 @@
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from urllib3.util.retry import Retry
+
+CHUNK_SIZE = 64 * 1024
+INDEX_FILE = "index.json"
+
+
+class CoverDownloader:
+    """并发下载封面到cover目录
+
+    所有下载共用一个连接池。index.json记录每个url对应的文件、ETag和Last-Modified，
+    以及每个文件内容的sha256，不同url内容相同的封面只保存一份。
+    """
+
+    def __init__(self, save_dir="cover", workers=8):
+        self.save_dir = save_dir
+        self.workers = workers
+        self.session = requests.Session()
+        retry = Retry(
+            total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504]
+        )
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=workers, pool_maxsize=workers, max_retries=retry
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.lock = threading.Lock()
+        self.index = {"urls": {}, "files": {}}
+        # 确保目录存在，如果不存在则创建
+        if not os.path.exists(save_dir):
+            os.makedirs(save_dir)
+        self.load_index()
+
+    def load_index(self):
+        path = os.path.join(self.save_dir, INDEX_FILE)
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                self.index = json.load(f)
+        # 之前下载的封面没有记录hash，补上用于去重
+        for name in os.listdir(self.save_dir):
+            if name == INDEX_FILE or name.endswith(".tmp"):
+                continue
+            if name not in self.index["files"]:
+                with open(os.path.join(self.save_dir, name), "rb") as f:
+                    self.index["files"][name] = hashlib.sha256(f.read()).hexdigest()
+
+    def save_index(self):
+        path = os.path.join(self.save_dir, INDEX_FILE)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(self.index, f, ensure_ascii=False, indent=1, sort_keys=True)
+        os.replace(path + ".tmp", path)
+
+    def find_file(self, sha256):
+        """查找内容相同的已有文件"""
+        for name, value in self.index["files"].items():
+            if value == sha256 and os.path.exists(os.path.join(self.save_dir, name)):
+                return name
+        return None
+
+    def download(self, url, refresh=False):
+        """下载一个封面，返回保存的路径，下载失败并且没有下载过时返回None"""
+        # 获取文件名，使用 URL 最后一个 '/' 之后的字符串
+        file_name = url.split("/")[-1] + ".jpg"
+        save_path = os.path.join(self.save_dir, file_name)
+        with self.lock:
+            entry = self.index["urls"].get(url)
+        if entry != None and os.path.exists(os.path.join(self.save_dir, entry["file"])):
+            path = os.path.join(self.save_dir, entry["file"])
+        elif os.path.exists(save_path):
+            path = save_path
+        else:
+            path = None
+        # 检查文件是否已经存在，如果存在则不进行下载，刷新时用条件请求确认是否有变化
+        if path != None and not refresh:
+            return path
+        headers = {}
+        if path != None and entry != None:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+        tmp = f"{save_path}.{threading.get_ident()}.tmp"
+        try:
+            response = self.session.get(url, headers=headers, stream=True, timeout=30)
+            if response.status_code == 304:
+                return path
+            if response.status_code != 200:
+                print(f"Failed to download image. Status code: {response.status_code}")
+                return path
+            sha256 = hashlib.sha256()
+            with open(tmp, "wb") as file:
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    sha256.update(chunk)
+                    file.write(chunk)
+        except requests.RequestException as e:
+            # 一个封面失败不影响同步，使用原来的封面链接
+            print(f"Failed to download image {url}: {e}")
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return path
+        sha256 = sha256.hexdigest()
+        with self.lock:
+            name = self.find_file(sha256)
+            if name == None:
+                # 先写临时文件再替换，避免留下不完整的图片
+                os.replace(tmp, save_path)
+                name = file_name
+                self.index["files"][name] = sha256
+                print(f"Image downloaded successfully to {save_path}")
+            else:
+                os.remove(tmp)
+            self.index["urls"][url] = {
+                "file": name,
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+            }
+        return os.path.join(self.save_dir, name)
+
+    def download_all(self, urls, refresh=False):
+        """并发下载多个封面，返回url到保存路径的字典，下载失败的封面不在其中"""
+        urls = list(dict.fromkeys(urls))
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            paths = executor.map(lambda url: self.download(url, refresh), urls)
+            result = {url: path for url, path in zip(urls, paths) if path != None}
+        self.save_index()
+        return result
@@ -0,0 +1,109 @@
+import os
+from collections import defaultdict
+from datetime import date, datetime, timedelta, timezone
+from xml.sax.saxutils import escape
+
+# 微信读书按北京时间统计每天的阅读时长
+CHINA = timezone(timedelta(hours=8))
+CELL = 11
+GAP = 2
+LEFT = 30
+TOP = 50
+MONTHS = ["1月", "2月", "3月", "4月", "5月", "6月", "7月", "8月", "9月", "10月", "11月", "12月"]
+WEEKDAYS = {1: "一", 3: "三", 5: "五"}
+DEFAULT_COLORS = {
+    "background": "#FFFFFF",
+    "track": "#ACE7AE",
+    "special1": "#69C16E",
+    "special2": "#549F57",
+    "dom": "#EBEDF0",
+    "text": "#000000",
+}
+
+
+def get_reading_days(read_info):
+    """从readinfo的readDetail中取出这本书每天的阅读秒数"""
+    detail = (read_info or {}).get("readDetail") or {}
+    days = defaultdict(int)
+    for x in detail.get("data") or []:
+        if x.get("readDate") and x.get("readTime"):
+            day = datetime.fromtimestamp(x["readDate"], CHINA).strftime("%Y-%m-%d")
+            days[day] += x["readTime"]
+    return dict(days)
+
+
+def get_summary_days(summary):
+    """从readdata/summary的readTimes中取出整个账号每天的阅读秒数，key是那天0点的时间戳"""
+    days = defaultdict(int)
+    for timestamp, seconds in ((summary or {}).get("readTimes") or {}).items():
+        day = datetime.fromtimestamp(int(timestamp), CHINA).strftime("%Y-%m-%d")
+        days[day] += seconds
+    return dict(days)
+
+
+def get_levels(seconds):
+    """阅读时长超过一半的天数用special1，前10%用special2"""
+    values = sorted(x for x in seconds if x > 0)
+    if len(values) == 0:
+        return 0, 0
+    return values[len(values) // 2], values[min(len(values) - 1, len(values) * 9 // 10)]
+
+
+def render_svg(days, year, title="", colors=None):
+    """生成一年的阅读热力图，每列是一周，颜色越深读得越久"""
+    colors = {**DEFAULT_COLORS, **(colors or {})}
+    first = date(year, 1, 1)
+    # 从1月1日所在那周的周日开始
+    start = first - timedelta(days=(first.weekday() + 1) % 7)
+    end = date(year, 12, 31)
+    seconds = {day: value for day, value in days.items() if day.startswith(f"{year}-")}
+    level1, level2 = get_levels(seconds.values())
+    weeks = (end - start).days // 7 + 1
+    width = LEFT + weeks * (CELL + GAP) + 10
+    height = TOP + 7 * (CELL + GAP) + 10
+    total = sum(seconds.values()) // 3600
+    text = f'fill="{colors["text"]}" font-family="sans-serif"'
+    lines = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}">',
+        f'<rect width="{width}" height="{height}" fill="{colors["background"]}"/>',
+        f'<text x="{LEFT}" y="20" font-size="14" {text}>'
+        f"{escape(title)} {year} 阅读{total}小时</text>",
+    ]
+    for month in range(1, 13):
+        x = LEFT + (date(year, month, 1) - start).days // 7 * (CELL + GAP)
+        lines.append(
+            f'<text x="{x}" y="{TOP - 6}" font-size="9" {text}>{MONTHS[month - 1]}</text>'
+        )
+    for index, name in WEEKDAYS.items():
+        y = TOP + index * (CELL + GAP) + CELL - 2
+        lines.append(f'<text x="0" y="{y}" font-size="9" {text}>{name}</text>')
+    day = first
+    while day <= end:
+        offset = (day - start).days
+        key = day.strftime("%Y-%m-%d")
+        value = seconds.get(key, 0)
+        if value == 0:
+            color = colors["dom"]
+        elif value >= level2:
+            color = colors["special2"]
+        elif value >= level1:
+            color = colors["special1"]
+        else:
+            color = colors["track"]
+        x = LEFT + offset // 7 * (CELL + GAP)
+        y = TOP + offset % 7 * (CELL + GAP)
+        lines.append(
+            f'<rect x="{x}" y="{y}" width="{CELL}" height="{CELL}" rx="2" fill="{color}">'
+            f"<title>{key} {value // 60}分钟</title></rect>"
+        )
+        day += timedelta(days=1)
+    lines.append("</svg>")
+    return "\n".join(lines) + "\n"
+
+
+def write_heatmap(path, days, year, title="", colors=None):
+    dirname = os.path.dirname(path)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(render_svg(days, year, title, colors))
@@ -0,0 +1,131 @@
+import hashlib
+from difflib import SequenceMatcher
+
+from planner import plan_requests
+
+
+def get_plain_text(block):
+    """获取block中的文字，notion返回的block和我们生成的block格式一致"""
+    rich_text = block.get(block.get("type"), {}).get("rich_text", [])
+    return "".join(x.get("text", {}).get("content", "") for x in rich_text)
+
+
+def block_fingerprint(block, has_quote):
+    """根据block的类型、文字、颜色、图标和是否有引用生成指纹，内容不变指纹就不变"""
+    type = block.get("type")
+    value = block.get(type, {})
+    icon = value.get("icon") or {}
+    content = "\x1f".join(
+        [
+            type,
+            get_plain_text(block),
+            value.get("color", ""),
+            icon.get("emoji", ""),
+            "1" if has_quote else "0",
+        ]
+    )
+    return hashlib.md5(content.encode("utf-8")).hexdigest()
+
+
+def describe_block(block, has_quote, id=None):
+    """记录block的id、类型、指纹和是否有子block，用于下次对比"""
+    return {
+        "id": block.get("id") if id == None else id,
+        "type": block.get("type"),
+        "fingerprint": block_fingerprint(block, has_quote),
+        "has_children": bool(has_quote),
+    }
+
+
+def list_children(client, limiter, block_id):
+    """获取page下所有的block"""
+    results = []
+    start_cursor = None
+    while True:
+        kwargs = dict(block_id=block_id, page_size=100)
+        if start_cursor != None:
+            kwargs["start_cursor"] = start_cursor
+        response = limiter.call(client.blocks.children.list, **kwargs)
+        results.extend(response.get("results"))
+        if not response.get("has_more"):
+            return results
+        start_cursor = response.get("next_cursor")
+
+
+def can_update(old, new, quote):
+    """类型相同且都没有引用的block可以直接原地修改"""
+    return (
+        old.get("type") == new.get("type")
+        and not old.get("has_children")
+        and quote == None
+    )
+
+
+def sync_children(client, limiter, page_id, children, grandchild, existing=None):
+    """对比page现有的block和新生成的block，只追加、修改、删除变化的部分
+
+    existing是本地记录的block，为None时从notion获取。
+    返回追加、修改、删除的block数量，以及同步后page的block记录
+    """
+    stats = {"appended": 0, "updated": 0, "archived": 0}
+    if existing == None:
+        existing = [
+            describe_block(x, x.get("has_children"))
+            for x in list_children(client, limiter, page_id)
+        ]
+    old = [x["fingerprint"] for x in existing]
+    layout = [
+        describe_block(x, i in grandchild) for i, x in enumerate(children)
+    ]
+    new = [x["fingerprint"] for x in layout]
+    archived = []
+    # (锚点, 需要插入的block下标)，锚点为None表示插入到最前面
+    inserts = []
+    anchor = None
+    matcher = SequenceMatcher(None, old, new, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            for k in range(i2 - i1):
+                layout[j1 + k]["id"] = existing[i1 + k]["id"]
+            anchor = existing[i2 - 1]["id"]
+            continue
+        for k in range(max(i2 - i1, j2 - j1)):
+            o = existing[i1 + k] if i1 + k < i2 else None
+            j = j1 + k if j1 + k < j2 else None
+            if o != None and j != None and can_update(o, children[j], grandchild.get(j)):
+                type = children[j]["type"]
+                limiter.call(client.blocks.update, block_id=o["id"], **{type: children[j][type]})
+                stats["updated"] += 1
+                layout[j]["id"] = o["id"]
+                anchor = o["id"]
+                continue
+            if o != None:
+                archived.append(o["id"])
+            if j != None:
+                if len(inserts) > 0 and inserts[-1][0] == anchor:
+                    inserts[-1][1].append(j)
+                else:
+                    inserts.append((anchor, [j]))
+    if len(inserts) > 0 and inserts[0][0] == None and len(existing) > len(archived):
+        # notion不支持插入到第一个block之前，这种情况只能整体重建
+        archived = [x["id"] for x in existing]
+        inserts = [(None, list(range(len(children))))]
+    for block_id in archived:
+        limiter.call(client.blocks.delete, block_id=block_id)
+        stats["archived"] += 1
+    for after, indexes in inserts:
+        quotes = {k: grandchild[j] for k, j in enumerate(indexes) if j in grandchild}
+        batches = plan_requests([children[j] for j in indexes], quotes)
+        for batch in batches:
+            kwargs = dict(block_id=page_id, children=batch)
+            if after != None:
+                kwargs["after"] = after
+            results = limiter.call(client.blocks.children.append, **kwargs).get(
+                "results"
+            )
+            for j, result in zip(indexes, results):
+                layout[j]["id"] = result["id"]
+            indexes = indexes[len(batch) :]
+            after = results[-1]["id"]
+            stats["appended"] += len(batch)
+    return stats, layout
@@ -0,0 +1,183 @@
+import asyncio
+import random
+import re
+import threading
+import time
+
+from notion_client.errors import HTTPResponseError, RequestTimeoutError
+
+# notion返回这些状态码时说明请求可以重试
+RETRY_STATUS = {429, 500, 502, 503, 504}
+# 这些接口不是幂等的，超时或5xx时可能已经写入了，重试会重复创建page或block
+NOT_IDEMPOTENT = {"pages.create", "blocks.children.append"}
+
+
+class TokenBucket:
+    """令牌桶，平均每秒rate个令牌，最多攒下burst个
+
+    同一个notion token的所有请求共用一个令牌桶，多个用户同步时也不会超出这个token的限额
+    """
+
+    def __init__(self, rate=3, burst=5):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def try_acquire(self):
+        """取一个令牌，取到时返回0，否则返回还需要等待的秒数"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if now >= self.paused_until and self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return max(self.paused_until - now, (1 - self.tokens) / self.rate)
+
+    def acquire(self):
+        """取一个令牌，没有令牌时等待，返回等待的秒数"""
+        waited = 0
+        while (wait := self.try_acquire()) > 0:
+            waited += wait
+            time.sleep(wait)
+        return waited
+
+    async def acquire_async(self):
+        """和acquire一样，等待时不阻塞事件循环"""
+        waited = 0
+        while (wait := self.try_acquire()) > 0:
+            waited += wait
+            await asyncio.sleep(wait)
+        return waited
+
+    def slow_down(self, delay):
+        """被限流时所有请求一起暂停delay秒，并把速率减半"""
+        with self.lock:
+            self.rate = max(self.rate / 2, 0.1)
+            self.tokens = 0
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+
+    def speed_up(self):
+        """请求成功后逐步恢复到设定的速率"""
+        if self.rate < self.max_rate:
+            with self.lock:
+                self.rate = min(self.max_rate, self.rate + 0.1)
+
+
+class Unlimited:
+    """不限速的令牌桶，回放录制的请求时使用"""
+
+    def try_acquire(self):
+        return 0
+
+    def acquire(self):
+        return 0
+
+    async def acquire_async(self):
+        return 0
+
+    def slow_down(self, delay):
+        pass
+
+    def speed_up(self):
+        pass
+
+
+class RateLimiter:
+    """所有notion请求都通过它发出
+
+    平均每秒rate个请求，最多允许burst个请求的突发。
+    遇到429或5xx时降低速率并等待Retry-After后重试，之后请求成功再慢慢恢复速率。
+    创建page和追加block只在429或带Retry-After的503时重试，这两种情况notion没有处理请求，
+    其它错误直接抛出，由journal当作不知道是否写入的步骤处理。
+    传入bucket时和其它RateLimiter共用令牌桶，请求的统计仍然记在各自的metrics里。
+    """
+
+    def __init__(self, rate=3, burst=5, max_retries=5, metrics=None, bucket=None):
+        self.bucket = bucket if bucket != None else TokenBucket(rate, burst)
+        self.max_retries = max_retries
+        self.metrics = metrics
+
+    def acquire(self):
+        waited = self.bucket.acquire()
+        if waited > 0 and self.metrics != None:
+            self.metrics.record_sleep(waited)
+
+    def call(self, func, *args, **kwargs):
+        """限速调用notion接口，失败时按Retry-After或指数退避重试"""
+        endpoint = endpoint_name(func)
+        for attempt in range(self.max_retries + 1):
+            self.acquire()
+            start = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            except (HTTPResponseError, RequestTimeoutError) as e:
+                self.retry(endpoint, start, e, attempt)
+                continue
+            self.record(endpoint, start, True)
+            self.bucket.speed_up()
+            return result
+
+    async def call_async(self, func, *args, **kwargs):
+        """和call一样，用于AsyncClient的接口，和同步的请求共用令牌桶"""
+        endpoint = endpoint_name(func)
+        for attempt in range(self.max_retries + 1):
+            waited = await self.bucket.acquire_async()
+            if waited > 0 and self.metrics != None:
+                self.metrics.record_sleep(waited)
+            start = time.perf_counter()
+            try:
+                result = await func(*args, **kwargs)
+            except (HTTPResponseError, RequestTimeoutError) as e:
+                self.retry(endpoint, start, e, attempt)
+                continue
+            self.record(endpoint, start, True)
+            self.bucket.speed_up()
+            return result
+
+    def retry(self, endpoint, start, error, attempt):
+        """请求失败，不能重试时抛出错误，否则降低速率等待下一次重试"""
+        self.record(endpoint, start, False)
+        if attempt == self.max_retries or not can_retry(endpoint, error):
+            raise error
+        if self.metrics != None:
+            self.metrics.record_retry("notion", endpoint)
+        self.bucket.slow_down(retry_after(error, attempt))
+
+    def record(self, endpoint, start, ok):
+        if self.metrics != None:
+            self.metrics.record("notion", endpoint, time.perf_counter() - start, ok)
+
+
+def endpoint_name(func):
+    """client.pages.create这样的方法记为pages.create"""
+    owner = getattr(func, "__self__", None)
+    if owner == None:
+        return func.__name__
+    name = type(owner).__name__.replace("Endpoint", "")
+    return re.sub(r"(?<!^)(?=[A-Z])", ".", name).lower() + "." + func.__name__
+
+
+def can_retry(endpoint, error):
+    status = getattr(error, "status", None)
+    if endpoint in NOT_IDEMPOTENT:
+        headers = getattr(error, "headers", None)
+        return status == 429 or (
+            status == 503 and headers is not None and bool(headers.get("Retry-After"))
+        )
+    return status is None or status in RETRY_STATUS
+
+
+def retry_after(error, attempt):
+    """优先使用Retry-After头，否则指数退避并加上随机抖动"""
+    headers = getattr(error, "headers", None)
+    if headers is not None and headers.get("Retry-After"):
+        try:
+            return float(headers.get("Retry-After"))
+        except ValueError:
+            pass
+    return min(2**attempt, 30) * (0.5 + random.random())
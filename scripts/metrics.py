@@ -0,0 +1,207 @@
+import contextvars
+import cProfile
+import io
+import json
+import pstats
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+from urllib.parse import parse_qs, urlparse
+
+
+def percentile(values, p):
+    if len(values) == 0:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+class Metrics:
+    """记录每个接口的请求次数、耗时、重试和等待的时间，以及每本书的耗时
+
+    微信读书通过session的response hook记录，notion通过RateLimiter记录，
+    运行结束后生成json和markdown格式的报告
+    """
+
+    def __init__(self, profile=False):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        # (服务, 接口) -> 每次请求的耗时
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.retries = defaultdict(int)
+        self.sleep_time = 0
+        self.books = {}
+        # 当前正在同步的书，在线程和writer的协程中互不影响
+        self.current_book = contextvars.ContextVar("bookId", default=None)
+        self.profiler = pstats.Stats() if profile else None
+        # 同一时间只能有一个profiler在运行
+        self.profile_lock = threading.Lock()
+
+    def record(self, service, endpoint, seconds, ok=True, bookId=None):
+        bookId = bookId or self.current_book.get()
+        with self.lock:
+            self.latencies[(service, endpoint)].append(seconds)
+            if not ok:
+                self.errors[(service, endpoint)] += 1
+            if bookId in self.books and f"{service}_calls" in self.books[bookId]:
+                self.books[bookId][f"{service}_calls"] += 1
+
+    def record_retry(self, service, endpoint):
+        with self.lock:
+            self.retries[(service, endpoint)] += 1
+
+    def record_sleep(self, seconds):
+        with self.lock:
+            self.sleep_time += seconds
+
+    def on_response(self, service):
+        """requests的response hook，记录请求的接口和耗时"""
+
+        def hook(response, *args, **kwargs):
+            url = urlparse(response.url)
+            bookId = parse_qs(url.query).get("bookId", [None])[0]
+            self.record(
+                service,
+                url.path,
+                response.elapsed.total_seconds(),
+                response.ok,
+                bookId,
+            )
+
+        return hook
+
+    @contextmanager
+    def book(self, bookId, title):
+        """统计一本书写入notion的耗时，期间的notion请求算在这本书上
+
+        同一本书可以进入多次，比如更新已有的page时发现page被删除了，再交给writer重新创建，耗时累加
+        """
+        with self.lock:
+            entry = self.books.setdefault(
+                bookId, {"title": title, "seconds": 0, "notion_calls": 0, "weread_calls": 0}
+            )
+            entry["title"] = title
+        token = self.current_book.set(bookId)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                entry["seconds"] = round(entry["seconds"] + time.perf_counter() - start, 3)
+            self.current_book.reset(token)
+
+    def expect_book(self, bookId):
+        """提前登记书，预取阶段的微信读书请求也能算在这本书上"""
+        with self.lock:
+            self.books.setdefault(
+                bookId, {"title": "", "seconds": 0, "notion_calls": 0, "weread_calls": 0}
+            )
+
+    def profiled(self, func):
+        """用cProfile统计函数的cpu耗时，支持生成器，可以在多个线程中调用"""
+        if self.profiler == None:
+            return func
+
+        def merge(profile, seconds):
+            self.record("cpu", func.__name__, seconds)
+            with self.lock:
+                self.profiler.add(profile)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            profile = cProfile.Profile()
+            start = time.perf_counter()
+            with self.profile_lock:
+                result = profile.runcall(func, *args, **kwargs)
+            if not hasattr(result, "__next__") or not hasattr(result, "send"):
+                merge(profile, time.perf_counter() - start)
+                return result
+            return profile_generator(result, profile, start)
+
+        def profile_generator(generator, profile, start):
+            try:
+                while True:
+                    with self.profile_lock:
+                        profile.enable()
+                        try:
+                            item = next(generator)
+                        except StopIteration:
+                            return
+                        finally:
+                            profile.disable()
+                    yield item
+            finally:
+                merge(profile, time.perf_counter() - start)
+
+        return wrapper
+
+    def summary(self):
+        endpoints = []
+        for (service, endpoint), values in sorted(self.latencies.items()):
+            endpoints.append(
+                {
+                    "service": service,
+                    "endpoint": endpoint,
+                    "count": len(values),
+                    "errors": self.errors[(service, endpoint)],
+                    "retries": self.retries[(service, endpoint)],
+                    "total": round(sum(values), 3),
+                    "p50": round(percentile(values, 0.5), 3),
+                    "p95": round(percentile(values, 0.95), 3),
+                    "max": round(max(values), 3),
+                }
+            )
+        return {
+            "started": self.started,
+            "seconds": round(time.time() - self.started, 3),
+            "sleep_seconds": round(self.sleep_time, 3),
+            "endpoints": endpoints,
+            "books": self.books,
+        }
+
+    def to_markdown(self, summary):
+        lines = [
+            "# 同步报告",
+            "",
+            f"总耗时 {summary['seconds']}s，限速等待 {summary['sleep_seconds']}s",
+            "",
+            "| 服务 | 接口 | 次数 | 失败 | 重试 | 总耗时(s) | p50 | p95 | max |",
+            "| --- | --- | ---: | ---: | ---: | ---: | ---: | ---: | ---: |",
+        ]
+        for x in summary["endpoints"]:
+            lines.append(
+                f"| {x['service']} | {x['endpoint']} | {x['count']} | {x['errors']} | {x['retries']}"
+                f" | {x['total']} | {x['p50']} | {x['p95']} | {x['max']} |"
+            )
+        books = sorted(summary["books"].items(), key=lambda x: -x[1]["seconds"])
+        if len(books) > 0:
+            lines += [
+                "",
+                "## 每本书",
+                "",
+                "| bookId | 书名 | 耗时(s) | notion请求 | 微信读书请求 |",
+                "| --- | --- | ---: | ---: | ---: |",
+            ]
+            for bookId, x in books:
+                lines.append(
+                    f"| {bookId} | {x['title']} | {x['seconds']} | {x['notion_calls']} | {x['weread_calls']} |"
+                )
+        if self.profiler != None and self.profiler.total_calls > 0:
+            output = io.StringIO()
+            self.profiler.stream = output
+            self.profiler.sort_stats("cumulative").print_stats(30)
+            lines += ["", "## CPU profile", "", "```", output.getvalue().strip(), "```"]
+        return "\n".join(lines) + "\n"
+
+    def write_report(self, path):
+        """写入path.json和path.md，开启profile时还会写入path.prof"""
+        summary = self.summary()
+        with open(f"{path}.json", "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        with open(f"{path}.md", "w", encoding="utf-8") as f:
+            f.write(self.to_markdown(summary))
+        if self.profiler != None and self.profiler.total_calls > 0:
+            self.profiler.dump_stats(f"{path}.prof")
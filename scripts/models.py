@@ -0,0 +1,115 @@
+import hashlib
+import heapq
+from typing import NamedTuple, Optional, Tuple
+
+
+def parse_range_start(value):
+    """划线的range形如"123-456"，取开始的位置用于排序，没有时为0"""
+    start = (value or "").split("-")[0]
+    return int(start) if start != "" else 0
+
+
+class Book(NamedTuple):
+    """笔记本列表中的一本书，只保留同步用到的字段"""
+
+    bookId: str
+    title: str
+    author: str
+    cover: str
+    version: Optional[int]
+    categories: Optional[Tuple[str, ...]]
+    sort: int
+    noteCount: int
+    reviewCount: int
+    bookmarkCount: int
+
+    @property
+    def fingerprint(self):
+        """笔记数量、sort或者版本变化时说明这本书需要重新检查"""
+        value = f"{self.noteCount}/{self.reviewCount}/{self.bookmarkCount}/{self.sort}/{self.version}"
+        return hashlib.md5(value.encode("utf-8")).hexdigest()
+
+    @classmethod
+    def from_json(cls, data):
+        book = data.get("book")
+        categories = book.get("categories")
+        return cls(
+            bookId=book.get("bookId"),
+            title=book.get("title"),
+            author=book.get("author"),
+            cover=book.get("cover"),
+            version=book.get("version"),
+            categories=tuple(x["title"] for x in categories)
+            if categories != None
+            else None,
+            sort=data.get("sort"),
+            noteCount=data.get("noteCount", 0),
+            reviewCount=data.get("reviewCount", 0),
+            bookmarkCount=data.get("bookmarkCount", 0),
+        )
+
+
+class Chapter(NamedTuple):
+    chapterUid: int
+    level: int
+    title: str
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data.get("chapterUid"), data.get("level"), data.get("title"))
+
+
+class Note(NamedTuple):
+    """一条划线或者笔记，划线没有reviewId，笔记没有bookmarkId
+
+    start是解析好的划线开始位置，和chapterUid一起作为排序的依据
+    """
+
+    chapterUid: int
+    start: int
+    markText: str
+    style: Optional[int]
+    colorStyle: Optional[int]
+    bookmarkId: Optional[str]
+    reviewId: Optional[str]
+    abstract: Optional[str]
+
+    @property
+    def sort_key(self):
+        return (self.chapterUid, self.start)
+
+    @classmethod
+    def from_bookmark(cls, data):
+        return cls(
+            chapterUid=data.get("chapterUid", 1),
+            start=parse_range_start(data.get("range")),
+            markText=data.get("markText", ""),
+            style=data.get("style"),
+            colorStyle=data.get("colorStyle"),
+            bookmarkId=data.get("bookmarkId"),
+            reviewId=None,
+            abstract=None,
+        )
+
+    @classmethod
+    def from_review(cls, data):
+        """data是笔记接口返回的review字段"""
+        return cls(
+            chapterUid=data.get("chapterUid", 1),
+            start=parse_range_start(data.get("range")),
+            markText=data.get("content", ""),
+            style=data.get("style"),
+            colorStyle=data.get("colorStyle"),
+            bookmarkId=None,
+            reviewId=data.get("reviewId"),
+            abstract=data.get("abstract"),
+        )
+
+
+def sort_notes(notes):
+    return sorted(notes, key=lambda x: x.sort_key)
+
+
+def merge_notes(bookmarks, reviews):
+    """按章节和位置合并已经排好序的划线和笔记，位置相同时划线在前"""
+    return heapq.merge(bookmarks, reviews, key=lambda x: x.sort_key)
@@ -0,0 +1,56 @@
+import json
+
+# notion api的限制：每个children数组最多100个block，一次请求最多1000个block，请求体最大500KB
+MAX_CHILDREN = 100
+MAX_BLOCKS = 1000
+MAX_PAYLOAD_BYTES = 450 * 1024
+
+
+def nest_quote(block, quote):
+    """把引用作为callout的子block，这样可以和callout在同一个请求里上传"""
+    type = block.get("type")
+    return {**block, type: {**block.get(type), "children": [quote]}}
+
+
+def count_blocks(block):
+    """block本身加上嵌套的子block数量"""
+    children = block.get(block.get("type"), {}).get("children", [])
+    return 1 + sum(count_blocks(x) for x in children)
+
+
+def plan_requests(children, grandchild):
+    """把block分成尽量少的请求，每个请求都不超过notion的限制
+
+    grandchild中的引用会嵌套到对应的callout里，不再单独请求。
+    返回的第一批可以随pages.create一起上传，之后每批一次blocks.children.append
+    """
+    return list(
+        iter_requests((block, grandchild.get(i)) for i, block in enumerate(children))
+    )
+
+
+def iter_requests(blocks):
+    """plan_requests的流式版本，blocks是(block, 引用)的迭代器，每凑满一个请求就返回一批"""
+    batch = []
+    count = 0
+    size = 0
+    for block, quote in blocks:
+        if quote != None:
+            block = nest_quote(block, quote)
+        n = count_blocks(block)
+        # 按json编码后的大小计算，中文会被转义成\uXXXX
+        s = len(json.dumps(block))
+        if len(batch) > 0 and (
+            len(batch) >= MAX_CHILDREN
+            or count + n > MAX_BLOCKS
+            or size + s > MAX_PAYLOAD_BYTES
+        ):
+            yield batch
+            batch = []
+            count = 0
+            size = 0
+        batch.append(block)
+        count += n
+        size += s
+    if len(batch) > 0:
+        yield batch
@@ -0,0 +1,174 @@
+"""在一个进程中同时为多个用户同步微信读书笔记
+
+    python scripts/runner.py tenants.json --parallel 8 --writers 4
+
+tenants.json的格式如下，每个用户的配置项和weread.py的命令行参数相同（-换成_），
+defaults中的配置对所有用户生效，以env:开头的值从环境变量中读取：
+
+    {
+        "defaults": {"ref": "refs/heads/main", "repository": "me/weread2notion", "incremental": true},
+        "tenants": [
+            {
+                "name": "alice",
+                "weread_cookie": "env:ALICE_WEREAD_COOKIE",
+                "notion_token": "env:ALICE_NOTION_TOKEN",
+                "database_id": "..."
+            }
+        ]
+    }
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from limiter import TokenBucket
+from weread import SyncContext, build_parser, sync
+
+POSITIONAL = ["weread_cookie", "notion_token", "database_id", "ref", "repository"]
+
+
+class FairScheduler:
+    """多个用户轮流写入notion，每次写一本书，写完重新排到队尾
+
+    同时最多有slots个用户在写入，书多的用户不会一直占着名额让其它用户等待
+    """
+
+    def __init__(self, slots=4):
+        self.slots = slots
+        self.waiting = deque()
+        self.condition = threading.Condition()
+
+    @contextmanager
+    def turn(self):
+        ticket = object()
+        with self.condition:
+            self.waiting.append(ticket)
+            while self.slots == 0 or self.waiting[0] is not ticket:
+                self.condition.wait()
+            self.waiting.popleft()
+            self.slots -= 1
+            self.condition.notify_all()
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.slots += 1
+                self.condition.notify_all()
+
+
+def resolve(value):
+    if isinstance(value, str) and value.startswith("env:"):
+        return os.environ[value[len("env:") :]]
+    return value
+
+
+def load_tenants(path, report_dir, workers):
+    """读取配置文件，返回每个用户的名字和weread.py的参数"""
+    with open(path, encoding="utf-8") as f:
+        config = json.load(f)
+    parser = build_parser()
+    tenants = []
+    for index, tenant in enumerate(config.get("tenants") or []):
+        values = dict(config.get("defaults") or {})
+        values.update(tenant)
+        values = {k.replace("-", "_"): resolve(v) for k, v in values.items()}
+        name = values.pop("name", None) or f"tenant{index}"
+        missing = [x for x in POSITIONAL if not values.get(x)]
+        if len(missing) > 0:
+            raise ValueError(f"{name} 缺少配置：{', '.join(missing)}")
+        options = parser.parse_args([str(values.pop(x)) for x in POSITIONAL])
+        # 每个用户的状态、缓存、封面和报告分开保存
+        options.state = os.path.join("data", name, "sync_state.db")
+        options.search_index = os.path.join("data", name, "search.db")
+        options.cache = os.path.join("cache", name)
+        options.cover_dir = os.path.join("cover", name)
+        options.report = os.path.join(report_dir, name)
+        options.workers = workers
+        for key, value in values.items():
+            if not hasattr(options, key):
+                raise ValueError(f"{name} 未知的配置项：{key}")
+            setattr(options, key, value)
+        tenants.append((name, options))
+    names = [name for name, _ in tenants]
+    if len(set(names)) != len(names):
+        raise ValueError("用户的name不能重复")
+    return tenants
+
+
+def run_tenant(name, options, bucket, scheduler):
+    """同步一个用户，出错时不影响其它用户，返回这个用户的结果"""
+    print(f"[{name}] 开始同步")
+    start = time.perf_counter()
+    result = {"name": name, "status": "ok", "books": 0, "error": None}
+    ctx = None
+    try:
+        ctx = SyncContext(options, bucket, scheduler)
+        result["books"] = sync(ctx)
+    except Exception as e:
+        traceback.print_exc()
+        result["status"] = "failed"
+        result["error"] = f"{type(e).__name__}: {e}"
+    finally:
+        if ctx != None:
+            # 先等正在写入notion的书完成，报告中的请求才完整
+            try:
+                ctx.close()
+            finally:
+                ctx.metrics.write_report(options.report)
+                summary = ctx.metrics.summary()
+                for service in ("weread", "notion"):
+                    result[f"{service}_calls"] = sum(
+                        x["count"] for x in summary["endpoints"] if x["service"] == service
+                    )
+                result["sleep_seconds"] = summary["sleep_seconds"]
+    result["seconds"] = round(time.perf_counter() - start, 3)
+    print(f"[{name}] 同步{'完成' if result['error'] == None else '失败'}")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="同时为多个用户同步微信读书笔记")
+    parser.add_argument("config", help="用户配置文件")
+    parser.add_argument("--parallel", type=int, default=8, help="同时同步的用户数")
+    parser.add_argument("--writers", type=int, default=4, help="同时写入notion的用户数")
+    parser.add_argument("--workers", type=int, default=2, help="每个用户请求微信读书的线程数")
+    parser.add_argument("--report-dir", default="reports", help="每个用户的运行报告的目录")
+    options = parser.parse_args()
+    tenants = load_tenants(options.config, options.report_dir, options.workers)
+    if not os.path.exists(options.report_dir):
+        os.makedirs(options.report_dir)
+    scheduler = FairScheduler(max(options.writers, 1))
+    # 同一个notion token的所有用户共用一个令牌桶
+    buckets = {}
+    for _, x in tenants:
+        if x.notion_token not in buckets:
+            buckets[x.notion_token] = TokenBucket(x.notion_rate, x.notion_burst)
+    with ThreadPoolExecutor(max_workers=max(options.parallel, 1)) as executor:
+        futures = [
+            executor.submit(run_tenant, name, x, buckets[x.notion_token], scheduler)
+            for name, x in tenants
+        ]
+        results = [future.result() for future in futures]
+    with open(os.path.join(options.report_dir, "runner.json"), "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"{'用户':<16}{'状态':>8}{'书':>6}{'耗时(s)':>10}{'notion':>8}{'weread':>8}")
+    for x in results:
+        print(
+            f"{x['name']:<16}{x['status']:>8}{x['books']:>6}{x['seconds']:>10}"
+            f"{x.get('notion_calls', 0):>8}{x.get('weread_calls', 0):>8}"
+        )
+        if x["error"] != None:
+            print(f"    {x['error']}")
+    if any(x["status"] != "ok" for x in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+"""在本地索引中搜索所有书的划线和笔记，不需要请求notion
+
+    python scripts/search.py 关键词 --book 书名 --color 1 --format markdown --output notes.md
+
+索引在每次同步时由weread.py增量更新，默认保存在data/search.db
+"""
+import argparse
+import csv
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+
+# 中文没有空格，每个字单独作为一个词索引，搜索时按短语匹配连续的字
+CJK = {
+    x: f" {chr(x)} "
+    for start, end in ((0x3400, 0x9FFF), (0xF900, 0xFAFF))
+    for x in range(start, end + 1)
+}
+COLUMNS = [
+    "book_id",
+    "title",
+    "author",
+    "chapter",
+    "kind",
+    "style",
+    "color",
+    "text",
+    "abstract",
+    "note_id",
+]
+
+
+def segment(text):
+    """在每个汉字两边加上空格，让unicode61分词把每个字当成一个词"""
+    if text == None:
+        return None
+    return text.translate(CJK)
+
+
+class SearchIndex:
+    """所有书的划线和笔记的全文索引
+
+    notes表保存每条划线和笔记，notes_fts是只有索引没有内容的FTS5表，索引分好词的内容和引用的原文；
+    books表记录每本书索引时的content_hash，内容没有变化的书不重新索引
+    """
+
+    def __init__(self, path):
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.create_function("segment", 1, segment, deterministic=True)
+        self.lock = threading.RLock()
+        with self.lock, self.conn:
+            self.conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS books (
+                    book_id TEXT PRIMARY KEY,
+                    title TEXT,
+                    author TEXT,
+                    content_hash TEXT
+                );
+                CREATE TABLE IF NOT EXISTS notes (
+                    id INTEGER PRIMARY KEY,
+                    book_id TEXT NOT NULL,
+                    chapter_uid INTEGER,
+                    chapter TEXT,
+                    start INTEGER,
+                    kind TEXT,
+                    style INTEGER,
+                    color INTEGER,
+                    note_id TEXT,
+                    text TEXT,
+                    abstract TEXT
+                );
+                CREATE INDEX IF NOT EXISTS notes_book ON notes (book_id, chapter_uid, start);
+                CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5 (
+                    text,
+                    abstract,
+                    content = ""
+                );
+                """
+            )
+            # 旧版本的索引把点评记在了第1章
+            if self.conn.execute("PRAGMA user_version").fetchone()[0] < 1:
+                self.conn.execute(
+                    "UPDATE notes SET chapter_uid = NULL, chapter = NULL WHERE kind = 'summary'"
+                )
+                self.conn.execute("PRAGMA user_version = 1")
+
+    def get_books(self):
+        """已经索引过的书"""
+        with self.lock:
+            rows = self.conn.execute("SELECT book_id FROM books").fetchall()
+        return {row["book_id"] for row in rows}
+
+    def update_book(self, book_id, title, author, chapter, summary, notes, content_hash):
+        """重新索引一本书，content_hash和上次一样时直接跳过
+
+        chapter是chapterUid到章节的字典，summary是点评，notes是划线和笔记
+        """
+        with self.lock, self.conn:
+            row = self.conn.execute(
+                "SELECT content_hash FROM books WHERE book_id = ?", (book_id,)
+            ).fetchone()
+            if row != None and row["content_hash"] == content_hash:
+                return False
+            # notes_fts没有保存内容，删除时要带上原来索引的内容
+            self.conn.execute(
+                "INSERT INTO notes_fts (notes_fts, rowid, text, abstract)"
+                " SELECT 'delete', id, segment(text), segment(abstract) FROM notes"
+                " WHERE book_id = ?",
+                (book_id,),
+            )
+            self.conn.execute("DELETE FROM notes WHERE book_id = ?", (book_id,))
+            items = [("review" if x.reviewId != None else "bookmark", x) for x in notes]
+            items += [("summary", x) for x in summary or []]
+            rows = []
+            for kind, x in items:
+                # 点评是对整本书的，没有章节
+                uid = x.chapterUid if kind != "summary" else None
+                name = None
+                if chapter != None and uid in chapter:
+                    name = chapter[uid].title
+                rows.append(
+                    (
+                        x.markText,
+                        x.abstract,
+                        book_id,
+                        uid,
+                        name,
+                        x.start,
+                        kind,
+                        x.style,
+                        x.colorStyle,
+                        x.reviewId or x.bookmarkId,
+                    )
+                )
+            self.conn.executemany(
+                "INSERT INTO notes (text, abstract, book_id, chapter_uid, chapter, start,"
+                " kind, style, color, note_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            self.conn.execute(
+                "INSERT INTO notes_fts (rowid, text, abstract)"
+                " SELECT id, segment(text), segment(abstract) FROM notes WHERE book_id = ?",
+                (book_id,),
+            )
+            self.conn.execute(
+                "INSERT OR REPLACE INTO books (book_id, title, author, content_hash)"
+                " VALUES (?, ?, ?, ?)",
+                (book_id, title, author, content_hash),
+            )
+        return True
+
+    def search(
+        self,
+        text=None,
+        book=None,
+        chapter=None,
+        color=None,
+        style=None,
+        kind=None,
+        limit=None,
+    ):
+        """按内容、书名或bookId、章节名、颜色、样式和类型查询，条件之间是并且的关系"""
+        where = []
+        params = []
+        words = re.findall(r"\w+", segment(text or ""))
+        if len(words) > 0:
+            # 整个关键词作为一个短语，不会被当成FTS5的查询语法
+            where.append(
+                "notes.id IN (SELECT rowid FROM notes_fts WHERE notes_fts MATCH ?)"
+            )
+            params.append('"' + " ".join(words) + '"')
+        if book:
+            where.append(
+                "notes.book_id IN"
+                " (SELECT book_id FROM books WHERE book_id = ? OR title LIKE ?)"
+            )
+            params += [book, f"%{book}%"]
+        if chapter:
+            where.append("notes.chapter LIKE ?")
+            params.append(f"%{chapter}%")
+        for column, value in (("color", color), ("style", style), ("kind", kind)):
+            if value != None:
+                where.append(f"notes.{column} = ?")
+                params.append(value)
+        sql = (
+            "SELECT notes.book_id, books.title, books.author, notes.chapter, notes.kind,"
+            " notes.style, notes.color, notes.text, notes.abstract, notes.note_id"
+            " FROM notes JOIN books ON books.book_id = notes.book_id"
+        )
+        if len(where) > 0:
+            sql += " WHERE " + " AND ".join(where)
+        # 和notion中一样，点评排在最后
+        sql += " ORDER BY books.title, notes.chapter_uid IS NULL, notes.chapter_uid, notes.start"
+        if limit != None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        with self.lock:
+            rows = self.conn.execute(sql, params).fetchall()
+        return [dict(row) for row in rows]
+
+    def close(self):
+        self.conn.close()
+
+
+def to_markdown(results):
+    lines = []
+    title = None
+    for x in results:
+        if x["title"] != title:
+            title = x["title"]
+            lines += ["", f"## {title}", ""]
+        prefix = f"{x['chapter']}：" if x["chapter"] else ""
+        lines.append(f"- {prefix}{x['text']}")
+        if x["abstract"]:
+            lines.append(f"  > {x['abstract']}")
+    return "\n".join(lines).strip() + "\n"
+
+
+def export(results, format, output):
+    if format == "json":
+        json.dump(results, output, ensure_ascii=False, indent=2)
+        output.write("\n")
+    elif format == "csv":
+        writer = csv.DictWriter(output, fieldnames=COLUMNS)
+        writer.writeheader()
+        writer.writerows(results)
+    elif format == "markdown":
+        output.write(to_markdown(results))
+    else:
+        for x in results:
+            chapter = f" / {x['chapter']}" if x["chapter"] else ""
+            output.write(f"[{x['title']}{chapter}] {x['text']}\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="搜索本地索引中的划线和笔记")
+    parser.add_argument("text", nargs="?", help="要搜索的内容")
+    parser.add_argument("--index", default="data/search.db", help="索引文件")
+    parser.add_argument("--book", help="书名的一部分或者bookId")
+    parser.add_argument("--chapter", help="章节名的一部分")
+    parser.add_argument("--color", type=int, help="划线颜色")
+    parser.add_argument("--style", type=int, help="划线样式")
+    parser.add_argument(
+        "--kind", choices=["bookmark", "review", "summary"], help="划线、笔记或者点评"
+    )
+    parser.add_argument("--limit", type=int, help="最多返回多少条")
+    parser.add_argument(
+        "--format", choices=["text", "json", "csv", "markdown"], default="text"
+    )
+    parser.add_argument("--output", help="导出到文件，默认输出到终端")
+    options = parser.parse_args()
+    if not os.path.exists(options.index):
+        sys.exit(f"{options.index} 不存在，请先运行一次同步")
+    index = SearchIndex(options.index)
+    results = index.search(
+        options.text,
+        options.book,
+        options.chapter,
+        options.color,
+        options.style,
+        options.kind,
+        options.limit,
+    )
+    index.close()
+    if options.output:
+        with open(options.output, "w", encoding="utf-8", newline="") as f:
+            export(results, options.format, f)
+        print(f"{len(results)}条结果已导出到 {options.output}")
+    else:
+        export(results, options.format, sys.stdout)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,336 @@
+import json
+import os
+import sqlite3
+import threading
+
+SCHEMA_VERSION = "1"
+
+
+class SyncState:
+    """本地保存的同步状态，记录每本书对应的notion page、sort、属性和block
+
+    有了它每次运行就不需要再去notion查询page了，只有本地状态不存在或者过期时才需要重新查询
+    journal表按顺序记录每本书写入notion的每一步，整本书同步完成后才清除，
+    中断后可以据此从上次完成的步骤继续
+    reading表记录每本书每天的阅读时长，account_reading表记录整个账号每天的阅读时长，
+    用来生成热力图，和notion无关，重置时不清除
+    """
+
+    def __init__(self, path):
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.lock = threading.RLock()
+        with self.lock, self.conn:
+            self.conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                );
+                CREATE TABLE IF NOT EXISTS books (
+                    book_id TEXT PRIMARY KEY,
+                    page_id TEXT NOT NULL,
+                    sort INTEGER NOT NULL DEFAULT 0,
+                    cover TEXT,
+                    properties TEXT,
+                    fingerprint TEXT,
+                    content_hash TEXT
+                );
+                CREATE TABLE IF NOT EXISTS blocks (
+                    book_id TEXT NOT NULL,
+                    position INTEGER NOT NULL,
+                    block_id TEXT NOT NULL,
+                    type TEXT NOT NULL,
+                    fingerprint TEXT NOT NULL,
+                    has_children INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (book_id, position)
+                );
+                CREATE TABLE IF NOT EXISTS journal (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    book_id TEXT NOT NULL,
+                    step TEXT NOT NULL,
+                    page_id TEXT,
+                    digest TEXT,
+                    done INTEGER NOT NULL DEFAULT 0
+                );
+                CREATE TABLE IF NOT EXISTS reading (
+                    book_id TEXT NOT NULL,
+                    day TEXT NOT NULL,
+                    seconds INTEGER NOT NULL,
+                    PRIMARY KEY (book_id, day)
+                );
+                CREATE TABLE IF NOT EXISTS account_reading (
+                    day TEXT PRIMARY KEY,
+                    seconds INTEGER NOT NULL
+                );
+                """
+            )
+            # 旧版本的状态文件没有这两列
+            columns = [x["name"] for x in self.conn.execute("PRAGMA table_info(books)")]
+            for column in ("fingerprint", "content_hash"):
+                if column not in columns:
+                    self.conn.execute(f"ALTER TABLE books ADD COLUMN {column} TEXT")
+
+    def get_meta(self, key):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT value FROM meta WHERE key = ?", (key,)
+            ).fetchone()
+        return row["value"] if row else None
+
+    def set_meta(self, key, value):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value)
+            )
+
+    def is_fresh(self, database_id):
+        """本地状态是否属于当前database并且是完整的"""
+        return (
+            self.get_meta("database_id") == database_id
+            and self.get_meta("schema_version") == SCHEMA_VERSION
+        )
+
+    def reset(self, database_id, pages):
+        """用从notion查询到的所有page替换本地状态，pages是bookId到(page id, sort)的字典
+
+        在一个事务中写入，查询中途失败时不会留下只有一部分书的状态
+        """
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM books")
+            self.conn.execute("DELETE FROM blocks")
+            for book_id, (page_id, sort) in pages.items():
+                self._save_book(book_id, page_id, sort, None, None, None, None)
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                [("database_id", database_id), ("schema_version", SCHEMA_VERSION)],
+            )
+
+    def get_book(self, book_id):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT * FROM books WHERE book_id = ?", (book_id,)
+            ).fetchone()
+        if row == None:
+            return None
+        book = dict(row)
+        if book["properties"] != None:
+            book["properties"] = json.loads(book["properties"])
+        return book
+
+    def get_sorts(self):
+        """所有书上次同步时的sort"""
+        with self.lock:
+            rows = self.conn.execute("SELECT book_id, sort FROM books").fetchall()
+        return {row["book_id"]: row["sort"] for row in rows}
+
+    def get_fingerprints(self):
+        """所有书上次同步时笔记本列表中的指纹，旧版本同步的书没有指纹"""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT book_id, fingerprint FROM books WHERE fingerprint IS NOT NULL"
+            ).fetchall()
+        return {row["book_id"]: row["fingerprint"] for row in rows}
+
+    def save_book(
+        self,
+        book_id,
+        page_id,
+        sort,
+        cover=None,
+        properties=None,
+        fingerprint=None,
+        content_hash=None,
+    ):
+        with self.lock, self.conn:
+            self._save_book(
+                book_id, page_id, sort, cover, properties, fingerprint, content_hash
+            )
+
+    def _save_book(
+        self, book_id, page_id, sort, cover, properties, fingerprint, content_hash
+    ):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO books"
+            " (book_id, page_id, sort, cover, properties, fingerprint, content_hash)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                book_id,
+                page_id,
+                sort,
+                cover,
+                json.dumps(properties, ensure_ascii=False)
+                if properties != None
+                else None,
+                fingerprint,
+                content_hash,
+            ),
+        )
+
+    def forget_book(self, book_id):
+        """page在notion中已经不存在了"""
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM books WHERE book_id = ?", (book_id,))
+            self.conn.execute("DELETE FROM blocks WHERE book_id = ?", (book_id,))
+
+    def get_blocks(self, book_id):
+        """按顺序返回page下的block，没有记录时返回None"""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT block_id, type, fingerprint, has_children FROM blocks"
+                " WHERE book_id = ? ORDER BY position",
+                (book_id,),
+            ).fetchall()
+        if len(rows) == 0:
+            return None
+        return [
+            {
+                "id": row["block_id"],
+                "type": row["type"],
+                "fingerprint": row["fingerprint"],
+                "has_children": bool(row["has_children"]),
+            }
+            for row in rows
+        ]
+
+    def get_block_counts(self):
+        """每本书上次写入notion的block数量"""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT book_id, COUNT(*) AS count FROM blocks GROUP BY book_id"
+            ).fetchall()
+        return {row["book_id"]: row["count"] for row in rows}
+
+    def save_blocks(self, book_id, blocks):
+        """blocks是按顺序排列的包含id、type、fingerprint、has_children的字典"""
+        with self.lock, self.conn:
+            self._save_blocks(book_id, blocks)
+
+    def _save_blocks(self, book_id, blocks):
+        self.conn.execute("DELETE FROM blocks WHERE book_id = ?", (book_id,))
+        self.conn.executemany(
+            "INSERT INTO blocks (book_id, position, block_id, type, fingerprint, has_children)"
+            " VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    book_id,
+                    position,
+                    block["id"],
+                    block["type"],
+                    block["fingerprint"],
+                    int(block["has_children"]),
+                )
+                for position, block in enumerate(blocks)
+            ],
+        )
+
+    def begin_step(self, book_id, step, page_id=None, digest=None):
+        """调用notion之前先在journal中记下这一步，返回这一步的id"""
+        with self.lock, self.conn:
+            cursor = self.conn.execute(
+                "INSERT INTO journal (book_id, step, page_id, digest) VALUES (?, ?, ?, ?)",
+                (book_id, step, page_id, digest),
+            )
+        return cursor.lastrowid
+
+    def finish_step(self, step_id, page_id=None):
+        """notion调用成功后标记这一步已经完成，创建page时同时记下page的id"""
+        with self.lock, self.conn:
+            self.conn.execute(
+                "UPDATE journal SET done = 1, page_id = COALESCE(?, page_id) WHERE id = ?",
+                (page_id, step_id),
+            )
+
+    def cancel_step(self, step_id):
+        """notion明确返回失败时删除这一步"""
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM journal WHERE id = ? AND done = 0", (step_id,))
+
+    def get_steps(self, book_id):
+        """这本书上次没有完成的同步中记录的步骤，按顺序排列"""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT id, step, page_id, digest, done FROM journal"
+                " WHERE book_id = ? ORDER BY id",
+                (book_id,),
+            ).fetchall()
+        return [
+            {
+                "id": row["id"],
+                "step": row["step"],
+                "page_id": row["page_id"],
+                "digest": row["digest"],
+                "done": bool(row["done"]),
+            }
+            for row in rows
+        ]
+
+    def get_unfinished_books(self):
+        """上次运行中断时还没有同步完的书"""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT DISTINCT book_id FROM journal ORDER BY book_id"
+            ).fetchall()
+        return [row["book_id"] for row in rows]
+
+    def clear_steps(self, book_id):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM journal WHERE book_id = ?", (book_id,))
+
+    def finish_book(
+        self,
+        book_id,
+        page_id,
+        sort,
+        cover,
+        properties,
+        blocks,
+        fingerprint=None,
+        content_hash=None,
+    ):
+        """在一个事务中保存这本书的同步结果并清除journal"""
+        with self.lock, self.conn:
+            self._save_blocks(book_id, blocks)
+            self._save_book(
+                book_id, page_id, sort, cover, properties, fingerprint, content_hash
+            )
+            self.conn.execute("DELETE FROM journal WHERE book_id = ?", (book_id,))
+
+    def save_reading(self, book_id, days):
+        """days是日期到这本书这天阅读秒数的字典，替换这本书之前的记录"""
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM reading WHERE book_id = ?", (book_id,))
+            self.conn.executemany(
+                "INSERT INTO reading (book_id, day, seconds) VALUES (?, ?, ?)",
+                [(book_id, day, seconds) for day, seconds in days.items()],
+            )
+
+    def save_account_reading(self, days, synckey=None):
+        """days是日期到整个账号这天阅读秒数的字典，只替换这些天的记录"""
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO account_reading (day, seconds) VALUES (?, ?)",
+                list(days.items()),
+            )
+            if synckey != None:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                    ("reading_synckey", str(synckey)),
+                )
+
+    def get_reading_days(self):
+        """每天的阅读秒数，有整个账号的记录时使用它，否则使用所有书加起来的"""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT day, SUM(seconds) AS seconds FROM reading GROUP BY day"
+            ).fetchall()
+            account = self.conn.execute("SELECT day, seconds FROM account_reading").fetchall()
+        days = {row["day"]: row["seconds"] for row in rows}
+        days.update({row["day"]: row["seconds"] for row in account})
+        return days
+
+    def close(self):
+        self.conn.close()
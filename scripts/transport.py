@@ -0,0 +1,138 @@
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# 微信读书返回这些状态码时说明请求可以重试
+RETRY_STATUS = {429, 500, 502, 503, 504}
+# 登录超时、cookie无效，重试也不会成功
+LOGIN_ERRCODES = {-2010, -2012}
+
+
+class WeReadError(Exception):
+    def __init__(self, message, errcode=None):
+        super().__init__(message)
+        self.errcode = errcode
+
+
+class CookieExpiredError(WeReadError):
+    pass
+
+
+class CircuitBreaker:
+    """连续threshold次请求失败后断开，之后的请求直接抛出错误，不再请求微信读书
+
+    cookie过期时立即断开，其它线程里排队的请求也不会再发出去
+    """
+
+    def __init__(self, threshold=5):
+        self.threshold = threshold
+        self.failures = 0
+        self.error = None
+        self.lock = threading.Lock()
+
+    def check(self):
+        if self.error != None:
+            raise self.error
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+
+    def failure(self, error, trip=False):
+        with self.lock:
+            self.failures += 1
+            if trip or self.failures >= self.threshold:
+                self.error = error
+
+
+class WeReadSession(requests.Session):
+    """所有微信读书请求都通过它发出
+
+    按线程数设置连接池大小并保持长连接，响应用gzip压缩。
+    遇到连接错误、超时、429或5xx时指数退避加随机抖动后重试，
+    返回errcode说明cookie过期时熔断，不再继续请求。
+    """
+
+    def __init__(self, cookies, pool_size=8, max_retries=3, metrics=None, timeout=(5, 30)):
+        super().__init__()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=max(pool_size, 1))
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+        self.headers["Accept-Encoding"] = "gzip, deflate"
+        if cookies != None:
+            self.cookies = cookies
+        self.max_retries = max_retries
+        self.metrics = metrics
+        self.timeout = timeout
+        self.breaker = CircuitBreaker()
+        # 回放录制的请求时不需要等待
+        self.sleep = time.sleep
+
+    def request(self, method, url, **kwargs):
+        self.breaker.check()
+        kwargs.setdefault("timeout", self.timeout)
+        endpoint = urlparse(url).path
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = super().request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == self.max_retries:
+                    self.breaker.failure(WeReadError(f"请求微信读书失败：{e}"))
+                    raise
+                self.wait(endpoint, attempt)
+                continue
+            if response.status_code not in RETRY_STATUS:
+                break
+            if attempt == self.max_retries:
+                self.breaker.failure(
+                    WeReadError(f"请求微信读书失败：{response.status_code}")
+                )
+                return response
+            self.wait(endpoint, attempt, response.headers.get("Retry-After"))
+        self.check_errcode(response)
+        return response
+
+    def wait(self, endpoint, attempt, retry_after=None):
+        """优先使用Retry-After头，否则指数退避并加上随机抖动"""
+        try:
+            delay = float(retry_after)
+        except (TypeError, ValueError):
+            delay = min(0.5 * 2**attempt, 8) * (0.5 + random.random())
+        if self.metrics != None:
+            self.metrics.record_retry("weread", endpoint)
+            self.metrics.record_sleep(delay)
+        self.sleep(delay)
+
+    def check_errcode(self, response):
+        """微信读书出错时返回errcode，cookie过期时熔断并抛出错误"""
+        # 只看开头，正常的响应不用多解析一次json
+        if b'"errcode"' not in response.content[:100]:
+            self.breaker.success()
+            return
+        try:
+            data = response.json()
+        except ValueError:
+            return
+        errcode = data.get("errcode")
+        if errcode in LOGIN_ERRCODES:
+            error = CookieExpiredError(
+                f"微信读书的cookie已过期，请重新获取：{data.get('errmsg')}", errcode
+            )
+            self.breaker.failure(error, trip=True)
+            raise error
+        if errcode != None and errcode != 0:
+            self.breaker.failure(WeReadError(f"微信读书返回错误：{data}", errcode))
+
+    def validate(self, url):
+        """检查cookie中有wr_skey，访问首页刷新cookie
+
+        首页在cookie过期时也返回成功，cookie是否有效要看之后i.weread.qq.com的接口返回的errcode
+        """
+        if not self.cookies.get("wr_skey"):
+            raise CookieExpiredError("cookie中缺少wr_skey，请重新获取微信读书的cookie")
+        response = self.get(url)
+        response.raise_for_status()
@@ -1,3 +1,12 @@
+import json
+
+# notion api 限制每段文字最多2000个字符，每个rich_text最多100段
+MAX_TEXT_LENGTH = 2000
+MAX_RICH_TEXT = 100
+# 单个block的大小上限，保证一个block总能放进一次请求里(notion限制请求最大500KB)
+MAX_BLOCK_BYTES = 400 * 1024
+
+
 def get_heading(level, content):
     if level == 1:
         heading = "heading_1"
@@ -68,16 +77,43 @@ def get_number(number):
     return {"number": number}
 
 
+def split_text(content):
+    """把长文字切成多段，每段不超过2000个字符"""
+    return [
+        content[i : i + MAX_TEXT_LENGTH]
+        for i in range(0, len(content), MAX_TEXT_LENGTH)
+    ]
+
+
+def get_text_segments(content):
+    """把文字转换成rich_text，超过2000个字符的分成多段"""
+    return [{"type": "text", "text": {"content": x}} for x in split_text(content)]
+
+
+def pack_text(content):
+    """把长文字分组，每组可以放到一个block的rich_text里，不会产生空的分组"""
+    groups = []
+    group = []
+    size = 0
+    for segment in split_text(content):
+        # 按json编码后的大小计算，中文会被转义成\uXXXX
+        n = len(json.dumps(segment))
+        if len(group) > 0 and (len(group) >= MAX_RICH_TEXT or size + n > MAX_BLOCK_BYTES):
+            groups.append("".join(group))
+            group = []
+            size = 0
+        group.append(segment)
+        size += n
+    if len(group) > 0:
+        groups.append("".join(group))
+    return groups
+
+
 def get_quote(content):
     return {
         "type": "quote",
         "quote": {
-            "rich_text": [
-                {
-                    "type": "text",
-                    "text": {"content": content},
-                }
-            ],
+            "rich_text": get_text_segments(content),
             "color": "default",
         },
     }
@@ -108,15 +144,20 @@ def get_callout(content, style, colorStyle, reviewId):
     return {
         "type": "callout",
         "callout": {
-            "rich_text": [
-                {
-                    "type": "text",
-                    "text": {
-                        "content": content,
-                    },
-                }
-            ],
+            "rich_text": get_text_segments(content),
             "icon": {"emoji": emoji},
             "color": color,
         },
     }
+
+
+def get_callouts(content, style, colorStyle, reviewId):
+    """把长文字打包到尽量少的callout里
+
+    返回callout列表，以及和每2000个字符一个callout相比节省的block数量
+    """
+    callouts = [
+        get_callout(x, style, colorStyle, reviewId) for x in pack_text(content)
+    ]
+    saved = len(content) // MAX_TEXT_LENGTH + 1 - len(callouts)
+    return callouts, saved
@@ -2,24 +2,48 @@ import argparse
 import json
 import logging
 import os
+import queue
 import re
-import time
-from notion_client import Client
-import requests
+import threading
+from collections import deque
+from itertools import groupby
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from notion_client import APIResponseError, Client
+import httpx
 from requests.utils import cookiejar_from_dict
 from http.cookies import SimpleCookie
 from datetime import datetime
 import hashlib
 
-from utils import get_callout, get_date, get_file, get_heading, get_icon, get_multi_select, get_number, get_quote, get_rich_text, get_select, get_table_of_contents, get_title, get_url
+from budget import TimeBudget, get_cost, prioritize
+from cache import ResponseCache
+from cassette import Cassette
+from cover import CoverDownloader
+from heatmap import get_reading_days, get_summary_days, write_heatmap
+from incremental import sync_children
+from limiter import RateLimiter, Unlimited
+from metrics import Metrics
+from models import Book, Chapter, Note, merge_notes, sort_notes
+from planner import iter_requests
+from search import SearchIndex
+from state import SyncState
+from transport import WeReadError, WeReadSession
+from utils import get_callouts, get_date, get_file, get_heading, get_icon, get_multi_select, get_number, get_quote, get_rich_text, get_select, get_table_of_contents, get_title, get_url
+from writer import NotionWriter
 
-WEREAD_URL = "https://weread.qq.com/"
-WEREAD_NOTEBOOKS_URL = "https://i.weread.qq.com/user/notebooks"
-WEREAD_BOOKMARKLIST_URL = "https://i.weread.qq.com/book/bookmarklist"
-WEREAD_CHAPTER_INFO = "https://i.weread.qq.com/book/chapterInfos"
-WEREAD_READ_INFO_URL = "https://i.weread.qq.com/book/readinfo"
-WEREAD_REVIEW_LIST_URL = "https://i.weread.qq.com/review/list"
-WEREAD_BOOK_INFO = "https://i.weread.qq.com/book/info"
+# 可以通过环境变量指向本地的模拟服务器，用于benchmark
+WEREAD_URL = os.getenv("WEREAD_URL", "https://weread.qq.com/")
+WEREAD_API_URL = os.getenv("WEREAD_API_URL", "https://i.weread.qq.com")
+NOTION_BASE_URL = os.getenv("NOTION_BASE_URL", "https://api.notion.com")
+WEREAD_NOTEBOOKS_URL = f"{WEREAD_API_URL}/user/notebooks"
+WEREAD_BOOKMARKLIST_URL = f"{WEREAD_API_URL}/book/bookmarklist"
+WEREAD_CHAPTER_INFO = f"{WEREAD_API_URL}/book/chapterInfos"
+WEREAD_READ_INFO_URL = f"{WEREAD_API_URL}/book/readinfo"
+WEREAD_REVIEW_LIST_URL = f"{WEREAD_API_URL}/review/list"
+WEREAD_BOOK_INFO = f"{WEREAD_API_URL}/book/info"
+WEREAD_READ_SUMMARY_URL = f"{WEREAD_API_URL}/readdata/summary"
+CONTENT_VERSION = 1
 
 
 def parse_cookie_string(cookie_string):
@@ -33,84 +57,178 @@ def parse_cookie_string(cookie_string):
     return cookiejar
 
 
-def get_bookmark_list(bookId):
+def get_bookmark_list(ctx, bookId):
     """获取我的划线"""
     params = dict(bookId=bookId)
-    r = session.get(WEREAD_BOOKMARKLIST_URL, params=params)
-    if r.ok:
-        updated = r.json().get("updated")
-        updated = sorted(
-            updated,
-            key=lambda x: (x.get("chapterUid", 1), int(x.get("range").split("-")[0])),
-        )
-        return r.json()["updated"]
-    return None
+    r = ctx.session.get(WEREAD_BOOKMARKLIST_URL, params=params)
+    # 失败时不能当作没有划线，否则会删除notion中已有的划线
+    r.raise_for_status()
+    data = r.json()
+    if "updated" not in data:
+        raise WeReadError(f"获取{bookId}的划线失败：{data}", data.get("errcode"))
+    return sort_notes(Note.from_bookmark(x) for x in data["updated"] or [])
 
 
-def get_read_info(bookId):
+def get_read_info(ctx, bookId):
     params = dict(bookId=bookId, readingDetail=1, readingBookIndex=1, finishedDate=1)
-    r = session.get(WEREAD_READ_INFO_URL, params=params)
+    r = ctx.session.get(WEREAD_READ_INFO_URL, params=params)
     if r.ok:
         return r.json()
     return None
 
 
-def get_bookinfo(bookId):
-    """获取书的详情"""
+def get_read_summary(ctx, synckey=0):
+    """获取整个账号每天的阅读时长，包括没有划线和笔记的书"""
+    r = ctx.session.get(WEREAD_READ_SUMMARY_URL, params=dict(synckey=synckey))
+    if r.ok and "readTimes" in r.json():
+        return r.json()
+    return None
+
+
+def get_bookinfo(ctx, bookId, version=None):
+    """获取书的详情，同一个version的书直接使用缓存"""
+    cached = ctx.cache.get("bookinfo", bookId, version)
+    if cached != None:
+        return tuple(cached["data"])
     params = dict(bookId=bookId)
-    r = session.get(WEREAD_BOOK_INFO, params=params)
-    isbn = ""
-    if r.ok:
-        data = r.json()
-        isbn = data["isbn"]
-        newRating = data["newRating"] / 1000
-        return (isbn, newRating)
-    else:
+    r = ctx.session.get(WEREAD_BOOK_INFO, params=params)
+    if r.status_code == 404:
         print(f"get {bookId} book info failed")
         return ("", 0)
+    # 重试后仍然失败时不能写入空的ISBN和评分，覆盖掉notion中已有的
+    r.raise_for_status()
+    data = r.json()
+    isbn = data["isbn"]
+    newRating = data["newRating"] / 1000
+    ctx.cache.set("bookinfo", bookId, version, [isbn, newRating])
+    return (isbn, newRating)
 
 
-def get_review_list(bookId):
-    """获取笔记"""
-    params = dict(bookId=bookId, listType=11, mine=1, syncKey=0)
-    r = session.get(WEREAD_REVIEW_LIST_URL, params=params)
-    reviews = r.json().get("reviews")
-    summary = list(filter(lambda x: x.get("review").get("type") == 4, reviews))
-    reviews = list(filter(lambda x: x.get("review").get("type") == 1, reviews))
-    reviews = list(map(lambda x: x.get("review"), reviews))
-    reviews = list(map(lambda x: {**x, "markText": x.pop("content")}, reviews))
+def get_review_list(ctx, bookId, version=None):
+    """获取笔记
+
+    带上缓存的syncKey只获取变化的笔记，再和缓存合并
+    """
+    cached = ctx.cache.get("reviews", bookId, version)
+    syncKey = cached["synckey"] if cached != None else 0
+    params = dict(bookId=bookId, listType=11, mine=1, syncKey=syncKey)
+    r = ctx.session.get(WEREAD_REVIEW_LIST_URL, params=params)
+    # 失败时不能当作没有笔记，否则会删除notion中已有的笔记
+    r.raise_for_status()
+    data = r.json()
+    reviews = {}
+    if cached != None:
+        reviews = {x.get("review").get("reviewId"): x for x in cached["data"]}
+    for x in data.get("reviews") or []:
+        reviews[x.get("review").get("reviewId")] = x
+    for reviewId in data.get("removed") or []:
+        reviews.pop(reviewId, None)
+    reviews = list(reviews.values())
+    ctx.cache.set("reviews", bookId, version, reviews, data.get("synckey", 0))
+    reviews = [x.get("review") for x in reviews]
+    summary = [Note.from_review(x) for x in reviews if x.get("type") == 4]
+    reviews = sort_notes(Note.from_review(x) for x in reviews if x.get("type") == 1)
     return summary, reviews
 
 
-def check(bookId):
-    """检查是否已经插入过 如果已经插入了就删除"""
-    time.sleep(0.3)
+def delete_page(ctx, page_id):
+    """删除page，page已经不存在时忽略"""
+    try:
+        ctx.limiter.call(ctx.client.blocks.delete, block_id=page_id)
+    except APIResponseError as e:
+        if not is_page_gone(e):
+            raise
+
+
+def find_pages(ctx, bookId):
+    """从notion查询这本书所有的page"""
     filter = {"property": "BookId", "rich_text": {"equals": bookId}}
-    response = client.databases.query(database_id=database_id, filter=filter)
-    for result in response["results"]:
-        time.sleep(0.3)
-        client.blocks.delete(block_id=result["id"])
+    response = ctx.limiter.call(
+        ctx.client.databases.query, database_id=ctx.database_id, filter=filter
+    )
+    return [x["id"] for x in response.get("results")]
+
+
+def delete_orphans(ctx, bookId):
+    """上次创建page时中断，不知道page是否已经创建，删除除了本地记录的page之外这本书所有的page"""
+    book = ctx.state.get_book(bookId)
+    for page_id in find_pages(ctx, bookId):
+        if book == None or book["page_id"] != page_id:
+            print(f"删除上次中断时创建的page {page_id}")
+            delete_page(ctx, page_id)
+
+
+async def delete_page_async(ctx, page_id):
+    try:
+        await ctx.writer.call(ctx.writer.client.blocks.delete, block_id=page_id)
+    except APIResponseError as e:
+        if not is_page_gone(e):
+            raise
 
 
-def get_chapter_info(bookId):
+def get_chapter_info(ctx, bookId):
     """获取章节信息"""
-    body = {"bookIds": [bookId], "synckeys": [0], "teenmode": 0}
-    r = session.post(WEREAD_CHAPTER_INFO, json=body)
-    if (
-        r.ok
-        and "data" in r.json()
-        and len(r.json()["data"]) == 1
-        and "updated" in r.json()["data"][0]
-    ):
-        update = r.json()["data"][0]["updated"]
-        return {item["chapterUid"]: item for item in update}
-    return None
+    return get_chapter_infos(ctx, [bookId]).get(bookId)
+
+
+def get_chapter_infos(ctx, bookIds, versions=None):
+    """一次请求获取多本书的章节信息，返回bookId到章节信息的字典
+
+    versions是bookId到book.version的字典，带上缓存的synckey，章节没有变化的书直接使用缓存
+    """
+    versions = versions or {}
+    cached = {
+        bookId: ctx.cache.get("chapters", bookId, versions.get(bookId)) for bookId in bookIds
+    }
+    chapters = {
+        bookId: {x["chapterUid"]: x for x in entry["data"]}
+        for bookId, entry in cached.items()
+        if entry != None
+    }
+    synckeys = [
+        cached[bookId]["synckey"] if cached[bookId] != None else 0 for bookId in bookIds
+    ]
+    body = {"bookIds": bookIds, "synckeys": synckeys, "teenmode": 0}
+    r = ctx.session.post(WEREAD_CHAPTER_INFO, json=body)
+    data = r.json().get("data") if r.ok else None
+    if data == None:
+        print(f"获取章节信息失败，使用缓存：{r.text[:200]}")
+        data = []
+    for index, item in enumerate(data):
+        bookId = item.get("bookId")
+        # 没有返回bookId时按请求的顺序对应
+        if bookId == None and len(data) == len(bookIds):
+            bookId = bookIds[index]
+        if bookId == None or "updated" not in item:
+            continue
+        updated = {x["chapterUid"]: x for x in item["updated"]}
+        if bookId in chapters and not item.get("clearAll"):
+            chapters[bookId].update(updated)
+        else:
+            chapters[bookId] = updated
+        ctx.cache.set(
+            "chapters",
+            bookId,
+            versions.get(bookId),
+            list(chapters[bookId].values()),
+            item.get("synckey", 0),
+        )
+    # 没有章节信息时生成的page没有目录、章节和引用，而且指纹会保存下来，之后不会再修复
+    missing = [bookId for bookId in bookIds if bookId not in chapters]
+    if len(missing) > 0:
+        raise WeReadError(f"获取章节信息失败，没有缓存的书：{missing}")
+    return to_chapters(chapters)
+
 
+def to_chapters(chapters):
+    return {
+        bookId: {uid: Chapter.from_json(x) for uid, x in value.items()}
+        for bookId, value in chapters.items()
+    }
 
-def insert_to_notion(bookName, bookId, cover, sort, author, isbn, rating, categories):
-    """插入到notion"""
-    time.sleep(0.3)
-    parent = {"database_id": database_id, "type": "database_id"}
+
+def get_properties(bookName, bookId, sort, author, isbn, rating, categories, read_info):
+    """生成page的属性"""
     properties = {
         "BookName":get_title(bookName),
         "BookId": get_rich_text(bookId),
@@ -122,7 +240,6 @@ def insert_to_notion(bookName, bookId, cover, sort, author, isbn, rating, catego
     }
     if categories != None:
         properties["Categories"] =get_multi_select(categories)
-    read_info = get_read_info(bookId=bookId)
     if read_info != None:
         markedStatus = read_info.get("markedStatus", 0)
         readingTime = read_info.get("readingTime", 0)
@@ -144,144 +261,478 @@ def insert_to_notion(bookName, bookId, cover, sort, author, isbn, rating, catego
             properties["Finish_Date"] = get_date(datetime.utcfromtimestamp(
                         read_info.get("finishedDate")
                     ).strftime("%Y-%m-%d %H:%M:%S"))
+    return properties
+
 
+async def insert_to_notion(ctx, cover, properties, children=None):
+    """插入到notion，children是随页面一起创建的第一批block"""
+    parent = {"database_id": ctx.database_id, "type": "database_id"}
     if cover.startswith("http"):
         ic1 = get_icon(cover)
+    kwargs = dict(parent=parent, cover=ic1, icon=ic1, properties=properties)
     # notion api 限制100个block
-    response = client.pages.create(parent=parent, cover=ic1,icon = ic1, properties=properties)
+    if children:
+        kwargs["children"] = children
+    response = await ctx.writer.call(ctx.writer.client.pages.create, **kwargs)
     id = response["id"]
     return id
 
 
-def add_children(id, children):
+def update_to_notion(ctx, id, cover, properties):
+    """原地更新已有page的属性"""
+    if cover.startswith("http"):
+        ic1 = get_icon(cover)
+    ctx.limiter.call(
+        ctx.client.pages.update, page_id=id, cover=ic1, icon=ic1, properties=properties
+    )
+
+
+async def add_children(ctx, id, batches):
+    """按planner分好的批次追加block，引用已经嵌套在callout里"""
     results = []
-    for i in range(0, len(children) // 100 + 1):
-        time.sleep(0.3)
-        response = client.blocks.children.append(
-            block_id=id, children=children[i * 100 : (i + 1) * 100]
+    for batch in batches:
+        response = await ctx.writer.call(
+            ctx.writer.client.blocks.children.append, block_id=id, children=batch
         )
         results.extend(response.get("results"))
-    return results if len(results) == len(children) else None
+    return results
+
 
+def get_content_hash(chapter, summary, notes, styles=None, colors=None):
+    """page内容依赖的章节、划线和笔记的hash，没有变化时不需要更新page的内容
 
-def add_grandchild(grandchild, results):
-    for key, value in grandchild.items():
-        time.sleep(0.3)
-        id = results[key].get("id")
-        client.blocks.children.append(block_id=id, children=[value])
+    修改了生成block的方式时需要修改CONTENT_VERSION，get_fingerprint也包含它，
+    所以所有书都会重新检查，内容有变化的page重新生成
+    """
+    content = [
+        CONTENT_VERSION,
+        sorted(chapter.values()) if chapter != None else None,
+        summary,
+        notes,
+        styles,
+        colors,
+    ]
+    return hashlib.md5(
+        json.dumps(content, ensure_ascii=False).encode("utf-8")
+    ).hexdigest()
 
 
-def get_notebooklist():
-    """获取笔记本列表"""
-    r = session.get(WEREAD_NOTEBOOKS_URL)
-    if r.ok:
-        data = r.json()
-        books = data.get("books")
-        books.sort(key=lambda x: x["sort"])
-        return books
+def get_fingerprint(ctx, book):
+    """保存在本地状态中的指纹，除了笔记本列表中的数据，还包括生成page的方式和划线的筛选条件"""
+    value = [book.fingerprint, CONTENT_VERSION, ctx.styles, ctx.colors]
+    return hashlib.md5(json.dumps(value).encode("utf-8")).hexdigest()
+
+
+def get_digest(batch):
+    return hashlib.md5(
+        json.dumps(batch, ensure_ascii=False, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+async def insert_book(ctx, bookId, cover, properties, batches, steps=()):
+    """创建page并逐批追加block，每一步之前先写journal，成功后再标记完成
+
+    steps是上次中断时journal中的记录，已经完成并且内容相同的步骤直接跳过。
+    返回page的id和是否全部写入，内容和上次对不上时返回False，需要和notion中已有的block对比
+    """
+    # 渲染block可能要等一会，放到线程池中取，不阻塞其它书的写入
+    batch = await ctx.writer.run_sync(next, batches, None)
+    id = None
+    for step in steps:
+        if step["step"] == "create" and step["done"]:
+            id = step["page_id"]
+        if not step["done"] or step["digest"] != get_digest(batch):
+            if id != None:
+                return id, False
+            # 上次创建page时中断，不知道是否创建成功，先删除可能已经创建的page再重新创建
+            await ctx.writer.run_sync(delete_orphans, ctx, bookId)
+            break
+        batch = await ctx.writer.run_sync(next, batches, None)
+    step = None
+    try:
+        if id == None:
+            ctx.state.clear_steps(bookId)
+            step = ctx.state.begin_step(bookId, "create", digest=get_digest(batch))
+            id = await insert_to_notion(ctx, cover, properties, batch)
+            ctx.state.finish_step(step, id)
+            batch = await ctx.writer.run_sync(next, batches, None)
+        else:
+            print(f"从上次中断的地方继续，跳过了{len(steps) - 1}批block")
+        while batch != None:
+            step = ctx.state.begin_step(bookId, "append", id, get_digest(batch))
+            await add_children(ctx, id, [batch])
+            ctx.state.finish_step(step)
+            batch = await ctx.writer.run_sync(next, batches, None)
+    except APIResponseError as e:
+        # notion明确拒绝了这次请求，这一步没有写入，下次可以直接重试
+        if step != None and e.status < 500:
+            ctx.state.cancel_step(step)
+        raise
+    return id, True
+
+
+async def write_book(ctx, book, cost, id, synced, cover, properties, content_hash, data, notes, steps, deletes, unchanged):
+    """在writer中写入一本书，不同的书同时写入
+
+    id不是None时在线程池中更新已有的page，page已经被删除或者id是None时创建新的page。
+    写入期间占用runner分配的名额，耗时和notion请求算在这本书上，写完后cost才算进时间预算里
+    """
+    try:
+        with ctx.metrics.book(book.bookId, book.title):
+            async with ctx.writer.hold(ctx.turn()):
+                if id != None:
+                    id = await ctx.writer.run_sync(
+                        update_book,
+                        ctx,
+                        book,
+                        id,
+                        synced,
+                        cover,
+                        properties,
+                        content_hash,
+                        data,
+                        notes,
+                        steps,
+                        deletes,
+                        unchanged,
+                    )
+                if id == None:
+                    await create_book(
+                        ctx, book, cover, properties, content_hash, data, notes, steps, deletes
+                    )
+    finally:
+        ctx.budget.finish(cost)
+
+
+async def create_book(ctx, book, cover, properties, content_hash, data, notes, steps, deletes):
+    """删除旧的page，创建新的page并追加block，最后保存同步结果
+
+    deletes是需要删除的旧page，每一项是journal中这一步的id和page的id。
+    边生成边上传，第一批block随页面一起创建
+    """
+    bookId = book.bookId
+    blocks = iter_blocks(data["chapter"], data["summary"], notes, ctx.styles, ctx.colors)
+    batches = prefetch(iter_requests(blocks))
+    try:
+        for step, page_id in deletes:
+            await delete_page_async(ctx, page_id)
+            ctx.state.finish_step(step)
+        id, complete = await insert_book(ctx, bookId, cover, properties, batches, steps)
+        # pages.create不会返回children的id，下次增量同步时再从notion获取
+        layout = []
+        if not complete:
+            print("上次中断后内容有变化，和notion中已经写入的block对比")
+            await ctx.writer.run_sync(update_to_notion, ctx, id, cover, properties)
+            layout = await ctx.writer.run_sync(sync_page, ctx, bookId, id, data, notes)
+        ctx.state.finish_book(
+            bookId,
+            id,
+            book.sort,
+            cover,
+            properties,
+            layout,
+            get_fingerprint(ctx, book),
+            content_hash,
+        )
+    finally:
+        batches.close()
+
+
+def update_book(ctx, book, id, synced, cover, properties, content_hash, data, notes, steps, deletes, unchanged):
+    """更新已有的page：属性有变化时更新属性，划线和笔记有变化时和notion中的block对比
+
+    在writer的线程池中执行，多本书同时更新。page已经被删除时返回None，需要重新创建
+    """
+    bookId = book.bookId
+    try:
+        if synced["cover"] != cover or synced["properties"] != properties:
+            update_to_notion(ctx, id, cover, properties)
+    except APIResponseError as e:
+        if not is_page_gone(e):
+            raise
+        ctx.state.forget_book(bookId)
+        return None
+    for step, page_id in deletes:
+        delete_page(ctx, page_id)
+    existing = ctx.state.get_blocks(bookId)
+    if unchanged:
+        print("划线和笔记没有变化，不需要更新内容")
+        layout = existing or []
     else:
+        if any(step["step"] == "sync" for step in steps):
+            # 上次对比到一半中断了，本地记录的block已经不准确
+            existing = None
+        layout = sync_page(ctx, bookId, id, data, notes, existing)
+    ctx.state.finish_book(
+        bookId,
+        id,
+        book.sort,
+        cover,
+        properties,
+        layout,
+        get_fingerprint(ctx, book),
+        content_hash,
+    )
+    return id
+
+
+def sync_page(ctx, bookId, id, data, notes, existing=None):
+    """和notion中已有的block对比，只修改变化的部分，返回page现在的block"""
+    children, grandchild = get_children(
+        data["chapter"], data["summary"], notes, ctx.styles, ctx.colors
+    )
+    ctx.state.begin_step(bookId, "sync", id)
+    try:
+        stats, layout = sync_children(
+            ctx.client, ctx.limiter, id, children, grandchild, existing
+        )
+    except APIResponseError as e:
+        if existing == None or not is_page_gone(e):
+            raise
+        # 本地记录的block已经过期，重新从notion获取
+        stats, layout = sync_children(ctx.client, ctx.limiter, id, children, grandchild)
+    print(
+        f"新增{stats['appended']}个block，修改{stats['updated']}个，删除{stats['archived']}个"
+    )
+    return layout
+
+
+def discard_journal(ctx):
+    """不续传时清理上次中断留下的journal
+
+    删除创建了一半的page和还没删除的旧page，正在增量同步的书下次重新从notion获取block
+    """
+    for bookId in ctx.state.get_unfinished_books():
+        book = ctx.state.get_book(bookId)
+        for step in ctx.state.get_steps(bookId):
+            if step["step"] == "create" and step["page_id"] != None:
+                if book == None or book["page_id"] != step["page_id"]:
+                    delete_page(ctx, step["page_id"])
+            elif step["step"] == "create":
+                delete_orphans(ctx, bookId)
+            elif step["step"] == "delete" and not step["done"]:
+                delete_page(ctx, step["page_id"])
+            elif step["step"] == "sync":
+                ctx.state.save_blocks(bookId, [])
+        ctx.state.clear_steps(bookId)
+
+
+def get_notebooklist(ctx):
+    """获取笔记本列表"""
+    r = ctx.session.get(WEREAD_NOTEBOOKS_URL)
+    if not r.ok:
         print(r.text)
-    return None
+    r.raise_for_status()
+    data = r.json()
+    if data.get("books") == None:
+        raise WeReadError(f"获取笔记本列表失败：{data}", data.get("errcode"))
+    books = [Book.from_json(x) for x in data.get("books")]
+    books.sort(key=lambda x: x.sort)
+    return books
 
 
-def get_sort():
-    """获取database中的最新时间"""
-    '''也就是说如果没有在本书继续做笔记，本书的sort就不会增加，否则增长；'''
-    '''这样在插入笔记时，就会先进行比较，若sort未增加，就会后续的修改记录，否则才会补充修改笔记'''
-    '''相当于减少不必要的程序运行'''
-    filter = {"property": "Sort", "number": {"is_not_empty": True}}
-    sorts = [
-        {
-            "property": "Sort",
-            "direction": "descending",
-        }
-    ]
-    response = client.databases.query(
-        database_id=database_id, filter=filter, sorts=sorts, page_size=1
+def fetch_book(ctx, executor, bookId, version, chapters, details=True):
+    """提交一本书需要的所有微信读书请求，这些请求之间互不依赖
+
+    chapters是批量获取章节信息的请求，多本书共用。
+    details为False时不获取只有page属性才用到的书的详情和阅读进度
+    """
+    futures = {
+        "bookId": bookId,
+        "chapters": chapters,
+        "bookmark_list": executor.submit(get_bookmark_list, ctx, bookId),
+        "review_list": executor.submit(get_review_list, ctx, bookId, version),
+    }
+    if details:
+        futures["bookinfo"] = executor.submit(get_bookinfo, ctx, bookId, version)
+        futures["read_info"] = executor.submit(get_read_info, ctx, bookId)
+    return futures
+
+
+def fetch_books(ctx, bookIds, versions, workers=8, chapter_batch_size=50, details=True):
+    """并发获取多本书的数据，按传入顺序返回每本书完整的数据
+
+    versions是bookId到book.version的字典，用于读取缓存。
+    章节信息每chapter_batch_size本书请求一次。
+    最多同时预取workers本书，避免一次性把所有书的数据都放在内存里
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        chapters = {}
+        for i in range(0, len(bookIds), chapter_batch_size):
+            batch = bookIds[i : i + chapter_batch_size]
+            future = executor.submit(get_chapter_infos, ctx, batch, versions)
+            for bookId in batch:
+                chapters[bookId] = future
+        pending = deque()
+        for bookId in bookIds:
+            pending.append(
+                fetch_book(
+                    ctx, executor, bookId, versions.get(bookId), chapters[bookId], details
+                )
+            )
+            if len(pending) >= workers:
+                yield collect_book(pending.popleft())
+        while pending:
+            yield collect_book(pending.popleft())
+
+
+def collect_book(futures):
+    """等待一本书的所有请求完成，没有获取详情时isbn、rating和read_info是None"""
+    isbn, rating = futures["bookinfo"].result() if "bookinfo" in futures else (None, None)
+    summary, reviews = futures["review_list"].result()
+    return {
+        "isbn": isbn,
+        "rating": rating,
+        "read_info": futures["read_info"].result() if "read_info" in futures else None,
+        "chapter": futures["chapters"].result().get(futures["bookId"]),
+        "bookmark_list": futures["bookmark_list"].result(),
+        "summary": summary,
+        "reviews": reviews,
+    }
+
+
+def discover_pages(ctx):
+    """从notion查询database中所有的书，重建本地状态
+
+    只有本地状态不存在或者已经过期的时候才需要调用，每100本书一次请求。
+    所有page都查询完之后才保存，中途失败时本地状态仍然是过期的，下次重新查询。
+    同一本书有多个page时，说明之前的状态丢失后重复创建了，只保留sort最大的那个
+    """
+    pages = {}
+    duplicates = []
+    start_cursor = None
+    while True:
+        kwargs = dict(database_id=ctx.database_id, page_size=100)
+        if start_cursor != None:
+            kwargs["start_cursor"] = start_cursor
+        response = ctx.limiter.call(ctx.client.databases.query, **kwargs)
+        for result in response.get("results"):
+            properties = result.get("properties")
+            bookId = "".join(
+                x.get("text", {}).get("content", "")
+                for x in properties.get("BookId", {}).get("rich_text", [])
+            )
+            sort = properties.get("Sort", {}).get("number") or 0
+            if bookId == "":
+                continue
+            if bookId not in pages:
+                pages[bookId] = (result["id"], sort)
+            elif pages[bookId][1] < sort:
+                duplicates.append(pages[bookId][0])
+                pages[bookId] = (result["id"], sort)
+            else:
+                duplicates.append(result["id"])
+        if not response.get("has_more"):
+            break
+        start_cursor = response.get("next_cursor")
+    if len(duplicates) > 0:
+        print(f"删除{len(duplicates)}个重复的page")
+        for page_id in duplicates:
+            delete_page(ctx, page_id)
+    ctx.state.reset(ctx.database_id, pages)
+
+
+def is_page_gone(e):
+    """page已经被删除或者归档了，本地记录已经过期"""
+    return e.code == "object_not_found" or (
+        e.code == "validation_error" and "archived" in str(e)
     )
-    if len(response.get("results")) == 1:
-        return response.get("results")[0].get("properties").get("Sort").get("number")
-    return 0
 
 
-def get_children(chapter, summary, bookmark_list):
-    children = []
-    grandchild = {}
+def iter_blocks(chapter, summary, notes, styles=None, colors=None):
+    """按顺序逐个生成page的block，notes是按章节和位置排好序的划线和笔记
+
+    每次返回(block, 引用)，没有引用时为None
+    """
+    # 长文字合并到一个callout后节省的block数量
+    saved = 0
     if chapter != None:
         # 添加目录
-        children.append(get_table_of_contents())
-        d = {}
-        for data in bookmark_list:
-            chapterUid = data.get("chapterUid", 1)
-            if chapterUid not in d:
-                d[chapterUid] = []
-            d[chapterUid].append(data)
-        for key, value in d.items():
-            if key in chapter:
-                # 添加章节
-                children.append(
-                    get_heading(
-                        chapter.get(key).get("level"), chapter.get(key).get("title")
-                    )
-                )
-            for i in value:
-                if data.get("reviewId") == None and "style" in i and "colorStyle" in i:
-                    if i.get("style") not in styles:
-                        continue
-                    if i.get("colorStyle") not in colors:
-                        continue
-                markText = i.get("markText")
-                for j in range(0, len(markText) // 2000 + 1):
-                    children.append(
-                        get_callout(
-                            markText[j * 2000 : (j + 1) * 2000],
-                            i.get("style"),
-                            i.get("colorStyle"),
-                            i.get("reviewId"),
-                        )
-                    )
-                if i.get("abstract") != None and i.get("abstract") != "":
-                    quote = get_quote(i.get("abstract"))
-                    grandchild[len(children) - 1] = quote
-
-    else:
-        # 如果没有章节信息
-        for data in bookmark_list:
-            if (
-                data.get("reviewId") == None
-                and "style" in data
-                and "colorStyle" in data
-            ):
-                if data.get("style") not in styles:
+        yield get_table_of_contents(), None
+    for chapterUid, value in groupby(notes, key=lambda x: x.chapterUid):
+        if chapter != None and chapterUid in chapter:
+            # 添加章节
+            yield get_heading(
+                chapter[chapterUid].level, chapter[chapterUid].title
+            ), None
+        for i in value:
+            if i.reviewId == None and i.style != None and i.colorStyle != None:
+                if styles != None and i.style not in styles:
                     continue
-                if data.get("colorStyle") not in colors:
+                if colors != None and i.colorStyle not in colors:
                     continue
-            markText = data.get("markText")
-            for i in range(0, len(markText) // 2000 + 1):
-                children.append(
-                    get_callout(
-                        markText[i * 2000 : (i + 1) * 2000],
-                        data.get("style"),
-                        data.get("colorStyle"),
-                        data.get("reviewId"),
-                    )
-                )
+            callouts, n = get_callouts(i.markText, i.style, i.colorStyle, i.reviewId)
+            saved += n
+            # 引用放在最后一个callout下面，没有章节信息时不添加引用
+            quote = None
+            if chapter != None and i.abstract:
+                quote = get_quote(i.abstract)
+            for index, callout in enumerate(callouts):
+                yield callout, quote if index == len(callouts) - 1 else None
     if summary != None and len(summary) > 0:
-        children.append(get_heading(1, "点评"))
+        yield get_heading(1, "点评"), None
         for i in summary:
-            content = i.get("review").get("content")
-            for j in range(0, len(content) // 2000 + 1):
-                children.append(
-                    get_callout(
-                        content[j * 2000 : (j + 1) * 2000],
-                        i.get("style"),
-                        i.get("colorStyle"),
-                        i.get("review").get("reviewId"),
-                    )
-                )
+            callouts, n = get_callouts(i.markText, i.style, i.colorStyle, i.reviewId)
+            saved += n
+            for callout in callouts:
+                yield callout, None
+    if saved > 0:
+        print(f"合并长文字，少生成了{saved}个block")
+
+
+def get_children(chapter, summary, notes, styles=None, colors=None):
+    """一次生成page所有的block，增量更新时需要完整的列表用来对比"""
+    children = []
+    grandchild = {}
+    for block, quote in iter_blocks(chapter, summary, notes, styles, colors):
+        if quote != None:
+            grandchild[len(children)] = quote
+        children.append(block)
     return children, grandchild
 
 
+def prefetch(iterable, size=2):
+    """在后台线程中提前生成数据，最多提前size个，上传的同时渲染后面的block"""
+    items = queue.Queue(maxsize=size)
+    stop = threading.Event()
+    done = object()
+
+    def produce():
+        try:
+            for item in iterable:
+                while not stop.is_set():
+                    try:
+                        items.put((item, None), timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if stop.is_set():
+                    return
+        except Exception as e:
+            items.put((done, e))
+            return
+        items.put((done, None))
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item, error = items.get()
+            if error != None:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+def get_cover_url(book):
+    cover = book.cover
+    if book.author == "公众号" and cover.endswith("/0"):
+        cover += ".jpg"
+    return cover
+
+
 def transform_id(book_id):
     id_length = len(book_id)
 
@@ -324,32 +775,7 @@ def calculate_book_str_id(book_id):
     return result
 
 
-def download_image(url, save_dir="cover"):
-    # 确保目录存在，如果不存在则创建
-    if not os.path.exists(save_dir):
-        os.makedirs(save_dir)
-
-    # 获取文件名，使用 URL 最后一个 '/' 之后的字符串
-    file_name = url.split("/")[-1] + ".jpg"
-    save_path = os.path.join(save_dir, file_name)
-
-    # 检查文件是否已经存在，如果存在则不进行下载
-    if os.path.exists(save_path):
-        print(f"File {file_name} already exists. Skipping download.")
-        return save_path
-
-    response = requests.get(url, stream=True)
-    if response.status_code == 200:
-        with open(save_path, "wb") as file:
-            for chunk in response.iter_content(chunk_size=128):
-                file.write(chunk)
-        print(f"Image downloaded successfully to {save_path}")
-    else:
-        print(f"Failed to download image. Status code: {response.status_code}")
-    return save_path
-
-
-if __name__ == "__main__":
+def build_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("weread_cookie")
     parser.add_argument("notion_token")
@@ -358,21 +784,206 @@ if __name__ == "__main__":
     parser.add_argument("repository")
     parser.add_argument("--styles", nargs="+", type=int, help="划线样式")
     parser.add_argument("--colors", nargs="+", type=int, help="划线颜色")
-    options = parser.parse_args()
-    weread_cookie = options.weread_cookie
-    database_id = options.database_id
-    notion_token = options.notion_token
-    ref = options.ref
-    branch = ref.split("/")[-1]
-    repository = options.repository
-    styles = options.styles
-    colors = options.colors
-    session = requests.Session()
-    session.cookies = parse_cookie_string(weread_cookie)
-    client = Client(auth=notion_token, log_level=logging.ERROR)
-    session.get(WEREAD_URL)
-    latest_sort = get_sort()
-    books = get_notebooklist() # books返回回来其实是个列表，列表形式如下
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="保留已有的page，只更新变化的划线和笔记，不再删除重建",
+    )
+    parser.add_argument(
+        "--state",
+        default="data/sync_state.db",
+        help="本地同步状态文件，记录每本书对应的page和block",
+    )
+    parser.add_argument(
+        "--search-index",
+        default="data/search.db",
+        help="划线和笔记的全文索引，用scripts/search.py搜索",
+    )
+    parser.add_argument("--cache", default="cache", help="微信读书数据的缓存目录")
+    parser.add_argument(
+        "--cache-size", type=int, default=64, help="缓存目录的最大大小，单位MB"
+    )
+    parser.add_argument("--workers", type=int, default=8, help="并发请求微信读书的线程数")
+    parser.add_argument("--cover-dir", default="cover", help="封面的保存目录")
+    parser.add_argument(
+        "--refresh-covers",
+        action="store_true",
+        help="用条件请求检查已经下载的封面是否有更新",
+    )
+    parser.add_argument(
+        "--chapter-batch-size",
+        type=int,
+        default=50,
+        help="每次请求多少本书的章节信息",
+    )
+    parser.add_argument(
+        "--notion-rate", type=float, default=3, help="notion每秒平均请求数"
+    )
+    parser.add_argument(
+        "--notion-burst", type=int, default=5, help="notion允许突发的请求数"
+    )
+    parser.add_argument(
+        "--notion-retries", type=int, default=5, help="notion限流或出错时的重试次数"
+    )
+    parser.add_argument(
+        "--weread-retries", type=int, default=3, help="微信读书连接失败或出错时的重试次数"
+    )
+    parser.add_argument(
+        "--notion-concurrency", type=int, default=4, help="同时写入notion的书的数量"
+    )
+    parser.add_argument(
+        "--time-budget",
+        type=float,
+        help="最多运行多少分钟，来不及同步的书留到下次优先同步",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="从上次中断的步骤继续，不再删除创建了一半的page",
+    )
+    parser.add_argument(
+        "--report",
+        default="report",
+        help="运行报告的路径前缀，会生成.json和.md两个文件",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="用cProfile统计生成block、排序等cpu耗时，写入报告和.prof文件",
+    )
+    cassette = parser.add_mutually_exclusive_group()
+    cassette.add_argument(
+        "--record", help="把微信读书和notion的所有请求和响应录制到这个文件，比如run.cassette.gz"
+    )
+    cassette.add_argument(
+        "--replay", help="离线回放录制的文件，不访问网络，也不修改本地的状态和缓存"
+    )
+    heatmap = parser.add_argument_group("热力图")
+    heatmap.add_argument("--heatmap", help="阅读热力图的保存路径，比如OUT_FOLDER/weread.svg")
+    heatmap.add_argument("--year", type=int, help="热力图的年份，默认是今年")
+    heatmap.add_argument("--me", default="", help="热力图标题中的名字")
+    heatmap.add_argument("--background-color", default="#FFFFFF")
+    heatmap.add_argument("--track-color", default="#ACE7AE")
+    heatmap.add_argument("--special-color1", default="#69C16E")
+    heatmap.add_argument("--special-color2", default="#549F57")
+    heatmap.add_argument("--dom-color", default="#EBEDF0")
+    heatmap.add_argument("--text-color", default="#000000")
+    return parser
+
+
+class SyncContext:
+    """一个用户同步时用到的session、notion client、本地状态和参数
+
+    所有访问微信读书和notion的函数都从这里取，同一个进程里可以同时同步多个用户
+    """
+
+    def __init__(self, options, bucket=None, scheduler=None):
+        self.cover_repo_dir = options.cover_dir
+        self.cassette = open_cassette(options)
+        self.options = options
+        self.database_id = options.database_id
+        self.repository = options.repository
+        self.branch = options.ref.split("/")[-1]
+        self.styles = options.styles
+        self.colors = options.colors
+        self.incremental = options.incremental
+        self.resume = options.resume
+        self.workers = max(options.workers, 1)
+        self.chapter_batch_size = max(options.chapter_batch_size, 1)
+        self.cover_dir = options.cover_dir
+        self.refresh_covers = options.refresh_covers
+        self.scheduler = scheduler
+        self.budget = TimeBudget(
+            options.time_budget * 60 if options.time_budget != None else None
+        )
+        self.metrics = Metrics(options.profile)
+        self.session = WeReadSession(
+            parse_cookie_string(options.weread_cookie),
+            self.workers,
+            options.weread_retries,
+            self.metrics,
+        )
+        self.session.hooks["response"].append(self.metrics.on_response("weread"))
+        self.client = Client(
+            auth=options.notion_token,
+            log_level=logging.ERROR,
+            base_url=NOTION_BASE_URL,
+            client=self.http_client(),
+        )
+        self.limiter = RateLimiter(
+            options.notion_rate,
+            options.notion_burst,
+            options.notion_retries,
+            self.metrics,
+            bucket,
+        )
+        self.writer = NotionWriter(
+            options.notion_token,
+            NOTION_BASE_URL,
+            self.limiter,
+            options.notion_concurrency,
+            self.cassette.async_transport() if self.cassette != None else None,
+        )
+        if self.cassette != None:
+            self.cassette.mount(self.session, pool_maxsize=self.workers)
+        if self.cassette != None and self.cassette.replay:
+            # 回放时不限速，也不等待重试
+            self.limiter.bucket = Unlimited()
+            self.session.sleep = lambda seconds: None
+        self.state = SyncState(options.state)
+        self.search = SearchIndex(options.search_index)
+        self.cache = ResponseCache(options.cache, options.cache_size * 1024 * 1024)
+
+    def http_client(self):
+        """录制或回放时notion的同步client使用的httpx client"""
+        if self.cassette == None:
+            return None
+        return httpx.Client(transport=self.cassette.transport())
+
+    def turn(self):
+        """轮到这个用户写入下一本书，多个用户一起同步时由runner调度"""
+        if self.scheduler == None:
+            return nullcontext()
+        return self.scheduler.turn()
+
+    def close(self):
+        self.writer.close()
+        self.session.close()
+        self.state.close()
+        self.search.close()
+        if self.cassette != None:
+            self.cassette.save()
+
+
+def open_cassette(options):
+    """--record时保存本地文件后开始录制，--replay时把录制时的本地文件解压到临时目录并使用它们"""
+    if options.replay != None:
+        cassette = Cassette(options.replay, replay=True)
+        paths = cassette.restore_snapshot(["state", "search", "cache", "cover"])
+        options.state = paths["state"]
+        options.search_index = paths["search"]
+        options.cache = paths["cache"]
+        options.cover_dir = paths["cover"]
+        return cassette
+    if options.record != None:
+        cassette = Cassette(options.record)
+        cassette.take_snapshot(
+            {
+                "state": options.state,
+                "search": options.search_index,
+                "cache": options.cache,
+                "cover": options.cover_dir,
+            }
+        )
+        return cassette
+    return None
+
+
+def sync(ctx):
+    """同步一个用户的所有书，返回这次同步的书的数量"""
+    ctx.session.validate(WEREAD_URL)
+    # 首页不检查登录状态，先获取笔记本列表，cookie过期时在修改notion之前就报错
+    books = get_notebooklist(ctx) # books返回回来其实是个列表，列表形式如下
     '''
     如，形式如下：
     [{'bookId': '23071792', 'book': {'bookId': '23071792', 'title': '简单统计学：如何轻松识破一本正经的胡说八道', 'author': '加里·史密斯', 'translator': '刘清山', 'cover': 'https://cdn.weread.qq.com/weread/cover/11/YueWen_23071792/s_YueWen_23071792.jpg', 'version': 1624236154, 'format': 'epub', 'type': 0, 'price': 14.99, 'originalPrice': 0, 'soldout': 0, 'bookStatus': 1, 'payType': 1048577, 'centPrice': 1499, 'finished': 1, 'maxFreeChapter': 5, 'free': 0, 'mcardDiscount': 0, 'ispub': 1, 'extra_type': 5, 'cpid': 9555120, 'publishTime': '2018-01-01 00:00:00', 'categories': [{'categoryId': 1100000, 'subCategoryId': 1100001, 'categoryType': 0, 'title': '经济理财-财经'}], 'hasLecture': 0, 'lastChapterIdx': 23, 'paperBook': {'skuId': '12246729'}, 'maxFreeInfo': {'maxFreeChapterIdx': 5, 'maxFreeChapterUid': 5, 'maxFreeChapterRatio': 15}, 'copyrightChapterUids': [2], 'hasKeyPoint': True, 'blockSaveImg': 0, 'language': 'zh', 'hideUpdateTime': False, 'isEPUBComics': 0, 'webBookControl': 0}, 'reviewCount': 0, 'reviewLikeCount': 0, 'reviewCommentCount': 0, 'noteCount': 157, 'bookmarkCount': 0, 'sort': 1566838330}, \
@@ -384,48 +995,230 @@ if __name__ == "__main__":
     {'bookId': '22291932', 'book': {'bookId': '22291932', 'title': '丰田一页纸极简思考法', 'author': '浅田卓', 'translator': '侯月', 'cover': 'https://wfqqreader-1252317822.image.myqcloud.com/cover/932/22291932/s_22291932.jpg', 'version': 1888460478, 'format': 'epub', 'type': 0, 'price': 19.9, 'originalPrice': 0, 'soldout': 0, 'bookStatus': 1, 'payType': 1048577, 'centPrice': 1990, 'finished': 1, 'maxFreeChapter': 6, 'free': 0, 'mcardDiscount': 0, 'ispub': 1, 'extra_type': 1, 'cpid': 9838507, 'publishTime': '2018-05-01 00:00:00', 'categories': [{'categoryId': 1100000, 'subCategoryId': 1100002, 'categoryType': 0, 'title': '经济理财-管理'}], 'hasLecture': 0, 'lastChapterIdx': 37, 'paperBook': {'skuId': '12351790'}, 'maxFreeInfo': {'maxFreeChapterIdx': 6, 'maxFreeChapterUid': 6, 'maxFreeChapterRatio': 35}, 'copyrightChapterUids': [2], 'hasKeyPoint': True, 'blockSaveImg': 0, 'language': 'zh', 'hideUpdateTime': False, 'isEPUBComics': 0, 'webBookControl': 0}, 'reviewCount': 0, 'reviewLikeCount': 0, 'reviewCommentCount': 0, 'noteCount': 5, 'bookmarkCount': 0, 'sort': 1574959640}, \
     {'bookId': '26454161', 'book': {'bookId': '26454161', 'title': '万物发明指南', 'author': '瑞安·诺思', 'translator': '王乔琦', 'cover': 'https://cdn.weread.qq.com/weread/cover/93/YueWen_26454161/s_YueWen_26454161.jpg', 'version': 2106389050, 'format': 'epub', 'type': 0, 'price': 46.8, 'originalPrice': 0, 'soldout': 0, 'bookStatus': 1, 'payType': 1048577, 'centPrice': 4680, 'finished': 1, 'maxFreeChapter': 18, 'free': 0, 'mcardDiscount': 0, 'ispub': 1, 'extra_type': 5, 'cpid': 4525313, 'publishTime': '2019-09-01 00:00:00', 'categories': [{'categoryId': 1500000, 'subCategoryId': 1500005, 'categoryType': 0, 'title': '科学技术-自然科学'}], 'hasLecture': 0, 'lastChapterIdx': 56, 'paperBook': {'skuId': '12698994'}, 'maxFreeInfo': {'maxFreeChapterIdx': 18, 'maxFreeChapterUid': 18, 'maxFreeChapterRatio': 53}, 'copyrightChapterUids': [2], 'hasKeyPoint': True, 'blockSaveImg': 0, 'language': 'zh', 'hideUpdateTime': False, 'isEPUBComics': 0, 'webBookControl': 0}, 'reviewCount': 0, 'reviewLikeCount': 0, 'reviewCommentCount': 0, 'noteCount': 2, 'bookmarkCount': 0, 'sort': 1575503418},]
     '''
+    if not ctx.resume:
+        discard_journal(ctx)
+    if not ctx.state.is_fresh(ctx.database_id):
+        discover_pages(ctx)
+    synced_sorts = ctx.state.get_sorts()
+    fingerprints = ctx.state.get_fingerprints()
+    # 中断时没有同步完的书，即使sort没有变化也要继续同步
+    unfinished = set(ctx.state.get_unfinished_books())
+    deferred = []
     if books != None:
-        for index, book in enumerate(books):
-            sort = book["sort"]
-            '''这里，其实就是将实时的sort记录时间，与notion中记录的sort时间latest_sort比较'''
-            '''如果，未增长，就没必要继续后面的程序，即continue；否则，再修改本书笔记'''
-            if sort <= latest_sort:
+        changed = [
+            (index, book)
+            for index, book in enumerate(books)
+            if book.bookId in unfinished
+            or (
+                get_fingerprint(ctx, book) != fingerprints[book.bookId]
+                if book.bookId in fingerprints
+                else book.sort > synced_sorts.get(book.bookId, 0)
+            )
+        ]
+        '''这里，其实就是将实时的sort记录时间，与上次同步时记录的sort比较'''
+        '''现在比较的是sort、笔记数量、版本和划线筛选条件的指纹，旧版本同步的书没有指纹时仍然比较sort'''
+        '''如果，未增长，就没必要继续后面的程序；否则，再修改本书笔记'''
+        '''需要同步的书会提前并发获取数据，写入notion时按顺序取用'''
+        # 最近读的书先同步，时间不够时留下的是很久没读的书，上次留下的书这次最先同步
+        block_counts = ctx.state.get_block_counts()
+        changed = prioritize(
+            changed, json.loads(ctx.state.get_meta("deferred") or "[]"), block_counts
+        )
+        # 先并发下载需要的封面
+        cover_urls = [get_cover_url(book) for _, book in changed]
+        downloader = CoverDownloader(ctx.cover_dir, ctx.workers)
+        downloader.session.hooks["response"].append(ctx.metrics.on_response("cover"))
+        if ctx.cassette != None:
+            ctx.cassette.mount(downloader.session)
+        covers = downloader.download_all(
+            [x for x in cover_urls if x.startswith("http") and not x.endswith(".jpg")],
+            ctx.refresh_covers,
+        )
+        for _, book in changed:
+            ctx.metrics.expect_book(book.bookId)
+        bundles = fetch_books(
+            ctx,
+            [book.bookId for _, book in changed],
+            {book.bookId: book.version for _, book in changed},
+            ctx.workers,
+            ctx.chapter_batch_size,
+        )
+        for position, ((index, book), data) in enumerate(zip(changed, bundles)):
+            if ctx.budget.expired():
+                deferred += [book.bookId for _, book in changed[position:]]
+                break
+            cost = get_cost(book, block_counts)
+            if not ctx.budget.fits(cost):
+                # 这本书来不及了，后面工作量小的书也许还来得及
+                deferred.append(book.bookId)
                 continue
-            book = book.get("book")
-            title = book.get("title")
-            cover = book.get("cover")
-            if book.get("author") == "公众号" and book.get("cover").endswith("/0"):
-                cover += ".jpg"
-            if cover.startswith("http") and not cover.endswith(".jpg"):
-                path = download_image(cover)
+            ctx.budget.start(cost)
+            sort = book.sort
+            title = book.title
+            cover = get_cover_url(book)
+            if cover in covers:
+                # 封面在仓库中的路径，回放时封面保存在临时目录里，链接仍然和录制时一样
+                path = os.path.relpath(covers[cover], ctx.cover_dir).replace(os.sep, "/")
+                path = f"{ctx.cover_repo_dir}/{path}"
                 cover = (
-                    f"https://raw.githubusercontent.com/{repository}/{branch}/{path}"
+                    f"https://raw.githubusercontent.com/{ctx.repository}/{ctx.branch}/{path}"
                 )
-            bookId = book.get("bookId")
-            author = book.get("author")
-            categories = book.get("categories")
+            bookId = book.bookId
+            author = book.author
+            categories = book.categories
             if categories != None:
-                categories = [x["title"] for x in categories]
+                categories = list(categories)
             print(f"正在同步 {title} ,一共{len(books)}本，当前是第{index+1}本。")
-            check(bookId)
-            isbn, rating = get_bookinfo(bookId)
-            id = insert_to_notion(
-                title, bookId, cover, sort, author, isbn, rating, categories
+            if data["read_info"] != None:
+                ctx.state.save_reading(bookId, get_reading_days(data["read_info"]))
+            notes = list(merge_notes(data["bookmark_list"], data["reviews"]))
+            content_hash = get_content_hash(
+                data["chapter"], data["summary"], notes, ctx.styles, ctx.colors
             )
-            chapter = get_chapter_info(bookId)
-            bookmark_list = get_bookmark_list(bookId)
-            summary, reviews = get_review_list(bookId)
-            bookmark_list.extend(reviews)
-            bookmark_list = sorted(
-                bookmark_list,
-                key=lambda x: (
-                    x.get("chapterUid", 1),
-                    0
-                    if (x.get("range", "") == "" or x.get("range").split("-")[0] == "")
-                    else int(x.get("range").split("-")[0]),
-                ),
+            ctx.search.update_book(
+                bookId, title, author, data["chapter"], data["summary"], notes, content_hash
             )
-            children, grandchild = get_children(chapter, summary, bookmark_list)
-            results = add_children(id, children)
-            if len(grandchild) > 0 and results != None:
-                add_grandchild(grandchild, results)
+            synced = ctx.state.get_book(bookId)
+            steps = ctx.state.get_steps(bookId)
+            # 划线、笔记和章节都没有变化，比如只是阅读进度变了，只需要更新属性
+            unchanged = (
+                synced != None
+                and synced["content_hash"] == content_hash
+                and len(steps) == 0
+            )
+            deletes = [
+                (step["id"], step["page_id"])
+                for step in steps
+                if step["step"] == "delete" and not step["done"]
+            ]
+            steps = [step for step in steps if step["step"] != "delete"]
+            id = None
+            if synced != None and (ctx.incremental or unchanged):
+                id = synced["page_id"]
+            elif synced != None:
+                # 已经插入过的page和新page一起交给writer删除，删除前先记到journal里
+                step = ctx.state.begin_step(bookId, "delete", synced["page_id"])
+                deletes.append((step, synced["page_id"]))
+                ctx.state.forget_book(bookId)
+            properties = get_properties(
+                title,
+                bookId,
+                sort,
+                author,
+                data["isbn"],
+                data["rating"],
+                categories,
+                data["read_info"],
+            )
+            # 更新已有的page和创建新的page都交给writer，不等写完就开始同步下一本书
+            ctx.writer.submit(
+                write_book(
+                    ctx,
+                    book,
+                    cost,
+                    id,
+                    synced,
+                    cover,
+                    properties,
+                    content_hash,
+                    data,
+                    notes,
+                    steps,
+                    deletes,
+                    unchanged,
+                )
+            )
+        ctx.writer.join()
+        bundles.close()
+        # 没有同步的书指纹没有更新，下次仍然会同步，这里只记录下次先同步哪些
+        ctx.state.set_meta("deferred", json.dumps(deferred))
+        if len(deferred) > 0:
+            print(f"时间不够，{len(deferred)}本书留到下次优先同步")
+    # 时间不够时跳过不影响notion的索引和热力图
+    if books != None and not ctx.budget.expired():
+        update_search_index(ctx, books, [book.bookId for _, book in changed])
+    if ctx.options.heatmap != None and not ctx.budget.expired():
+        update_heatmap(ctx)
+    ctx.cache.evict()
+    return len(changed) - len(deferred) if books != None else 0
+
+
+def update_search_index(ctx, books, synced):
+    """把这次没有同步、也从来没有索引过的书加到搜索索引里，只请求微信读书，不写入notion
+
+    只获取划线、笔记和章节，每本书之前检查时间预算，来不及的书下次再索引
+    """
+    indexed = ctx.search.get_books() | set(synced)
+    missing = [book for book in books if book.bookId not in indexed]
+    if len(missing) == 0:
+        return
+    print(f"索引{len(missing)}本书的划线和笔记")
+    bundles = fetch_books(
+        ctx,
+        [book.bookId for book in missing],
+        {book.bookId: book.version for book in missing},
+        ctx.workers,
+        ctx.chapter_batch_size,
+        details=False,
+    )
+    for book, data in zip(missing, bundles):
+        if ctx.budget.expired():
+            print("时间不够，剩下的书下次再索引")
+            break
+        notes = list(merge_notes(data["bookmark_list"], data["reviews"]))
+        content_hash = get_content_hash(
+            data["chapter"], data["summary"], notes, ctx.styles, ctx.colors
+        )
+        ctx.search.update_book(
+            book.bookId,
+            book.title,
+            book.author,
+            data["chapter"],
+            data["summary"],
+            notes,
+            content_hash,
+        )
+    bundles.close()
+
+
+def update_heatmap(ctx):
+    """生成阅读热力图
+
+    整个账号每天的阅读时长从readdata/summary获取，带上次的synckey只获取变化的天。
+    获取失败时使用同步时每本书readinfo中的记录，只有笔记本列表中的书，没有划线和笔记的书不算在内
+    """
+    summary = get_read_summary(ctx, ctx.state.get_meta("reading_synckey") or 0)
+    if summary != None:
+        ctx.state.save_account_reading(get_summary_days(summary), summary.get("synckey"))
+    else:
+        print("获取阅读记录失败，热力图中只有有划线和笔记的书的阅读时长")
+    options = ctx.options
+    colors = {
+        "background": options.background_color,
+        "track": options.track_color,
+        "special1": options.special_color1,
+        "special2": options.special_color2,
+        "dom": options.dom_color,
+        "text": options.text_color,
+    }
+    year = options.year or datetime.now().year
+    write_heatmap(options.heatmap, ctx.state.get_reading_days(), year, options.me, colors)
+    print(f"热力图已写入 {options.heatmap}")
+
+
+if __name__ == "__main__":
+    options = build_parser().parse_args()
+    ctx = SyncContext(options)
+    if options.profile:
+        iter_blocks = ctx.metrics.profiled(iter_blocks)
+        sort_notes = ctx.metrics.profiled(sort_notes)
+        calculate_book_str_id = ctx.metrics.profiled(calculate_book_str_id)
+    try:
+        sync(ctx)
+    finally:
+        # 同步失败时也要写报告，先等正在写入notion的书完成，请求才能统计完整
+        try:
+            ctx.close()
+        finally:
+            ctx.metrics.write_report(options.report)
+            print(f"运行报告已写入 {options.report}.md")
@@ -0,0 +1,89 @@
+import asyncio
+import contextvars
+import logging
+import threading
+from concurrent.futures import wait
+from contextlib import asynccontextmanager
+
+import httpx
+from notion_client import AsyncClient
+
+
+class NotionWriter:
+    """在后台线程的事件循环中用AsyncClient并发写入notion
+
+    每本书的写入是一个协程，同一个page的请求在协程中按顺序执行，不同的书同时写入。
+    最多同时写入concurrency本书，所有请求通过limiter和同步的请求共用令牌桶。
+    """
+
+    def __init__(self, auth, base_url, limiter, concurrency=4, transport=None):
+        self.limiter = limiter
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.slots = threading.Semaphore(max(concurrency, 1))
+        self.futures = []
+        self.client = self.run(self.create_client(auth, base_url, transport))
+
+    async def create_client(self, auth, base_url, transport=None):
+        client = httpx.AsyncClient(transport=transport) if transport != None else None
+        return AsyncClient(
+            auth=auth, base_url=base_url, log_level=logging.ERROR, client=client
+        )
+
+    def run(self, coroutine):
+        """在事件循环中执行coroutine并等待结果"""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def call(self, func, *args, **kwargs):
+        """在协程中限速调用AsyncClient的接口"""
+        return self.limiter.call_async(func, *args, **kwargs)
+
+    async def run_sync(self, func, *args):
+        """在线程池中执行同步的函数，不阻塞其它书的写入，请求仍然算在当前的书上"""
+        context = contextvars.copy_context()
+        return await self.loop.run_in_executor(None, context.run, func, *args)
+
+    @asynccontextmanager
+    async def hold(self, manager):
+        """在线程池中进入会阻塞的同步context manager，比如等待runner分配写入的名额"""
+        await self.run_sync(manager.__enter__)
+        try:
+            yield
+        finally:
+            manager.__exit__(None, None, None)
+
+    def submit(self, coroutine):
+        """提交一本书的写入，同时写入的书达到上限时等待，之前的写入失败时抛出错误"""
+        try:
+            self.raise_errors(block=False)
+            self.slots.acquire()
+        except BaseException:
+            coroutine.close()
+            raise
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        future.add_done_callback(lambda _: self.slots.release())
+        self.futures.append(future)
+        return future
+
+    def raise_errors(self, block=True):
+        if block:
+            wait(self.futures)
+        futures = [x for x in self.futures if x.done()]
+        for future in futures:
+            if future.exception() != None:
+                raise future.exception()
+        self.futures = [x for x in self.futures if not x.done()]
+
+    def join(self):
+        """等待所有写入完成，有失败时抛出第一个错误"""
+        self.raise_errors()
+
+    def close(self):
+        # 中途取消可能留下已经创建但没有记到journal里的page，等正在写入的书完成
+        wait(self.futures)
+        self.futures = []
+        self.run(self.client.aclose())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()